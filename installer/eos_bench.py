@@ -0,0 +1,189 @@
+#!/bin/env python
+
+import subprocess
+import os
+import sys
+import time
+import json
+import argparse
+import statistics
+
+# region EpsilonOS Helpers
+def RealPath(filePath):
+    return os.path.realpath(os.path.expanduser(filePath))
+def GetEnvironmentDir():
+    return os.path.dirname(RealPath(__file__))
+def ReadFile(filePath, defaultContents=None, binary=False):
+    filePath = RealPath(filePath)
+    try:
+        with open(filePath, "rb" if binary else "r", encoding=None if binary else "utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        if defaultContents != None:
+            return defaultContents
+        else:
+            raise
+def RunCommand(command, echo=False, capture=False, input=None, check=True, env=None):
+    if echo and capture:
+        raise Exception("Command cannot be run with both echo and capture.")
+    result = subprocess.run(command, stdout=(None if echo else subprocess.PIPE), stderr=(None if echo else subprocess.STDOUT), input=input, env=env, check=False, shell=True, text=True)
+    if check and result.returncode != 0:
+        raise Exception(f"Sub-process returned non-zero exit code.\nExitCode: {result.returncode}\nCmdLine: {command}\n\n{result.stdout}")
+    if capture and not check:
+        return result.stdout.strip(), result.returncode
+    elif capture:
+        return result.stdout.strip()
+    elif not check:
+        return result.returncode
+    else:
+        return
+def PrintWarning(message):
+	print(f"\033[93mWarning: {message}\033[0m")
+def PrintError(message):
+	print(f"\033[91mERROR: {message}\033[0m")
+# endregion
+
+# Benchmarks eos_install end to end without a spare disk.
+# Each scenario gets sparse image files attached as loop devices and its own offline.conf, then eos_install runs
+# against them from a local package repository so the timings do not depend on the mirrors. Under EOS_INSTALL_BENCH the
+# installer leaves the mirrorlist of this machine alone and uses the cached IntegraBoot and yay-bin without checking for updates.
+# The per phase timings of every run are appended to a results file so installer changes can be compared over time.
+#
+# Populate the package cache once before benchmarking with: sudo eos_install cache populate /var/cache/eos_install
+
+INSTALLER_PATH = os.path.join(GetEnvironmentDir(), "eos_install.py")
+BENCH_PIN = "1234"
+BENCH_PASSWORD = "eos_bench"
+
+# Every combination of a separate efi_drive, encryption, and tty_only.
+SCENARIOS = [
+	{ "name": f"{"split" if separateEfi else "shared"}-{"luks" if encrypted else "plain"}-{"tty" if ttyOnly else "desktop"}", "separate_efi": separateEfi, "encrypted": encrypted, "tty_only": ttyOnly }
+	for separateEfi in [ False, True ] for encrypted in [ False, True ] for ttyOnly in [ True, False ]
+]
+
+# Creates a sparse image file and attaches it with partition scanning so /dev/loopNp1 and /dev/loopNp2 show up.
+def AttachImage(imagePath, sizeGiB):
+	RunCommand(f"truncate -s {sizeGiB}G \"{imagePath}\"")
+	return RunCommand(f"losetup -f --show -P \"{imagePath}\"", capture=True)
+
+# Tears down whatever an install left behind, even one which failed halfway.
+def Cleanup(loopDevices, imagePaths):
+	RunCommand("umount -R /new_root", check=False)
+	RunCommand("cryptsetup close new_cryptroot", check=False)
+	for loopDevice in loopDevices:
+		RunCommand(f"losetup -d \"{loopDevice}\"", check=False)
+	for imagePath in imagePaths:
+		if os.path.exists(imagePath):
+			os.remove(imagePath)
+
+def RunScenario(scenario, runIndex, args):
+	scenarioDir = os.path.join(args.workdir, scenario['name'])
+	os.makedirs(scenarioDir, exist_ok=True)
+	imagePaths = [ os.path.join(scenarioDir, "root.img") ]
+	if scenario['separate_efi']:
+		imagePaths.append(os.path.join(scenarioDir, "efi.img"))
+	reportPath = os.path.join(scenarioDir, "report.json")
+	if os.path.exists(reportPath):
+		os.remove(reportPath)
+	loopDevices = []
+	try:
+		loopDevices.append(AttachImage(imagePaths[0], args.size))
+		if scenario['separate_efi']:
+			loopDevices.append(AttachImage(imagePaths[1], 1))
+		conf = "\n".join([
+			f"root_drive={loopDevices[0]}",
+			f"efi_drive={loopDevices[-1]}",
+			f"pin={BENCH_PIN}",
+			f"password={BENCH_PASSWORD if scenario['encrypted'] else ""}",
+			f"tty_only={scenario['tty_only']}",
+			f"swap_size={args.swap_size}",
+			f"package_cache={args.cache}",
+			f"local_repo=True",
+		]) + "\n"
+		# Written fresh for every run since the loop device numbers can change between runs.
+		with open(os.path.join(scenarioDir, "offline.conf"), "w", encoding="utf-8") as f:
+			f.write(conf)
+		env = dict(os.environ, EOS_INSTALL_BENCH="1", EOS_INSTALL_REPORT=reportPath)
+		print(f"----- {scenario['name']} run {runIndex + 1} of {args.runs} on {" ".join(loopDevices)} -----")
+		startTime = time.monotonic()
+		exitStatus = RunCommand(f"cd \"{scenarioDir}\" && python \"{INSTALLER_PATH}\"", echo=True, check=False, env=env)
+		wallTime = time.monotonic() - startTime
+	finally:
+		Cleanup(loopDevices, imagePaths)
+	report = json.loads(ReadFile(reportPath, defaultContents="null"))
+	if exitStatus != 0 or report == None:
+		PrintError(f"eos_install failed in scenario {scenario['name']} with exit status {exitStatus}.")
+	return {
+		"scenario": scenario['name'],
+		"run": runIndex,
+		"exit_status": exitStatus,
+		"wall_time": round(wallTime, 3),
+		"installer_version": None if report == None else report['installer_version'],
+		"phases": {} if report == None else { phase['name']: phase['wall_time'] for phase in report['phases'] },
+	}
+
+def PrintSummary(results):
+	for scenario in SCENARIOS:
+		runs = [ result for result in results if result['scenario'] == scenario['name'] and result['exit_status'] == 0 ]
+		if len(runs) == 0:
+			continue
+		print(f"{scenario['name']} ({len(runs)} runs)")
+		print(f"  {"Phase":<16} {"Median":>9} {"Min":>9} {"Max":>9}")
+		names = []
+		for run in runs:
+			names += [ name for name in run['phases'] if not name in names ]
+		for name in names + [ "total" ]:
+			times = [ run['wall_time'] if name == "total" else run['phases'][name] for run in runs if name == "total" or name in run['phases'] ]
+			print(f"  {name:<16} {statistics.median(times):>8.1f}s {min(times):>8.1f}s {max(times):>8.1f}s")
+		print()
+
+def Main():
+	parser = argparse.ArgumentParser(description="Benchmarks eos_install against loop devices backed by sparse image files.")
+	parser.add_argument("--runs", type=int, default=3, help="runs of each scenario")
+	parser.add_argument("--scenario", action="append", default=[], help="only run this scenario, may be repeated (default: all of them)")
+	parser.add_argument("--cache", default="/var/cache/eos_install", help="package cache populated with eos_install cache populate")
+	parser.add_argument("--workdir", default="/var/tmp/eos_bench", help="where image files and offline.conf files are kept")
+	parser.add_argument("--size", type=int, default=16, help="size of the root image in GiB")
+	parser.add_argument("--swap-size", type=int, default=1073741824, help="swap_size passed to eos_install in bytes")
+	parser.add_argument("--output", default="./eos_bench.json", help="results file which each run is appended to")
+	parser.add_argument("--list", action="store_true", help="list the scenarios and exit")
+	args = parser.parse_args()
+
+	if args.list:
+		for scenario in SCENARIOS:
+			print(scenario['name'])
+		return 0
+	if os.geteuid() != 0 or os.getegid() != 0:
+		PrintError(f"Root is required to run eos_bench. Try sudo eos_bench.")
+		return 1
+	scenarios = [ scenario for scenario in SCENARIOS if len(args.scenario) == 0 or scenario['name'] in args.scenario ]
+	for name in args.scenario:
+		if not name in [ scenario['name'] for scenario in SCENARIOS ]:
+			PrintError(f"Unknown scenario {name}. Try eos_bench --list.")
+			return 1
+	args.cache = RealPath(args.cache)
+	if not os.path.isfile(os.path.join(args.cache, "eos_local.db")):
+		PrintError(f"{args.cache} is not a populated package cache. Try sudo eos_install cache populate {args.cache}.")
+		return 1
+	if os.path.ismount("/new_root"):
+		PrintError("Something is already mounted at /new_root. Please manually unmount.")
+		return 1
+	args.workdir = RealPath(args.workdir)
+	args.output = RealPath(args.output)
+
+	# Runs are interleaved across scenarios so slow drift in the host affects every scenario alike.
+	commit, status = RunCommand(f"git -C \"{GetEnvironmentDir()}\" rev-parse --short HEAD", capture=True, check=False)
+	session = { "started": time.time(), "commit": commit if status == 0 else None, "runs": [] }
+	for runIndex in range(args.runs):
+		for scenario in scenarios:
+			session['runs'].append(RunScenario(scenario, runIndex, args))
+			print()
+
+	history = json.loads(ReadFile(args.output, defaultContents="[]"))
+	history.append(session)
+	with open(args.output, "w", encoding="utf-8") as f:
+		f.write(json.dumps(history, indent=4) + "\n")
+	PrintSummary(session['runs'])
+	print(f"Results were appended to {args.output}.")
+	return 0 if all([ run['exit_status'] == 0 for run in session['runs'] ]) else 1
+sys.exit(Main())
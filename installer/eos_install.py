@@ -5,6 +5,14 @@ import subprocess
 import os
 import sys
 import shutil
+import secrets
+import hashlib
+import math
+import glob
+import time
+import json
+import threading
+import concurrent.futures
 
 # region EpsilonOS Helpers
 def RealPath(filePath):
@@ -41,15 +49,37 @@ def ReadFile(filePath, defaultContents=None, binary=False):
 def RunCommand(command, echo=False, capture=False, input=None, check=True, env=None):
     if echo and capture:
         raise Exception("Command cannot be run with both echo and capture.")
-    result = subprocess.run(command, stdout=(None if echo else subprocess.PIPE), stderr=(None if echo else subprocess.STDOUT), input=input, env=env, check=False, shell=True, text=True)
-    if check and result.returncode != 0:
-        raise Exception(f"Sub-process returned non-zero exit code.\nExitCode: {result.returncode}\nCmdLine: {command}\n\n{result.stdout}")
+    # wait4 is used instead of subprocess.run so the CPU time of this exact child can be recorded.
+    startTime = time.monotonic()
+    process = subprocess.Popen(command, stdin=(None if input == None else subprocess.PIPE), stdout=(None if echo else subprocess.PIPE), stderr=(None if echo else subprocess.STDOUT), env=env, shell=True, text=True)
+    # Input is written from its own thread so a child which fills the stdout pipe before reading all of it cannot deadlock.
+    writer = None
+    if input != None:
+        def WriteInput():
+            try:
+                process.stdin.write(input)
+                process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+        writer = threading.Thread(target=WriteInput)
+        writer.start()
+    stdout = None
+    if not echo:
+        stdout = process.stdout.read()
+        process.stdout.close()
+    if writer != None:
+        writer.join()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    RecordCommand(command, process.returncode, time.monotonic() - startTime, usage.ru_utime + usage.ru_stime)
+    if check and process.returncode != 0:
+        raise Exception(f"Sub-process returned non-zero exit code.\nExitCode: {process.returncode}\nCmdLine: {command}\n\n{stdout}")
     if capture and not check:
-        return result.stdout.strip(), result.returncode
+        return stdout.strip(), process.returncode
     elif capture:
-        return result.stdout.strip()
+        return stdout.strip()
     elif not check:
-        return result.returncode
+        return process.returncode
     else:
         return
 def PrintWarning(message):
@@ -68,7 +98,14 @@ def Choice(prompt=None):
 			print(f"{userChoice} is not a valid choice. Please enter (Y)es or (N)o: ")
 # endregion
 
-CONF_KEYS = [ "root_drive", "pin", "tty_only", "password", "efi_drive", "swap_size" ]
+# Phases use this instead of CreateFile so running them again after an interrupted install does not fail.
+def CreateOrWriteFile(filePath, contents, mode):
+	if os.path.exists(RealPath(filePath)):
+		WriteFile(filePath, contents)
+	else:
+		CreateFile(filePath, contents, mode)
+
+CONF_KEYS = [ "root_drive", "pin", "tty_only", "password", "efi_drive", "swap_size", "package_cache", "local_repo", "golden_image" ]
 DEFAULT_CONF = """# Sets the drive where EpsilonOS should be installed. (e.g. /dev/sda)
 root_drive=
 
@@ -93,6 +130,20 @@ efi_drive=
 # Sets the size of the swapfile in bytes. (e.g. 8589934592 for 8 GiB)
 # 0 means no swapfile. Leave ths field black for the same amount of swap as physical memory.
 swap_size=
+
+# Sets a directory on the installing machine where downloaded packages are kept between installs. (e.g. /var/cache/eos_install)
+# Leave this field blank to download every package from the mirrors into a temporary cache in /tmp.
+package_cache=
+
+# If local_repo=True then packages are installed from the file:// repository in package_cache built by eos_install cache populate.
+# The mirrors are then neither ranked nor contacted, and cached IntegraBoot and yay-bin are used without checking for updates.
+# If local_repo=False then package_cache is only used to keep packages downloaded from the mirrors.
+local_repo=False
+
+# Sets a golden image built with eos_install golden to deploy instead of installing packages. (e.g. /mnt/epsilonos.tar.zst)
+# Only the per machine steps such as fstab, the pin, swap, and IntegraBoot run after the image is extracted.
+# Leave this field blank for a normal install.
+golden_image=
 """
 
 DEPENDENCIES = [
@@ -109,143 +160,370 @@ DEPENDENCIES = [
 	("pacstrap", "arch-install-scripts"),
 	("arch-chroot", "arch-install-scripts"),
 	("ping", "iputils"),
-	("curl", "curl")
+	("curl", "curl"),
+	("tar", "tar"),
+	("zstd", "zstd")
 ]
 
-def Main():
-	# NOTE outdated gpg keys on the host will cause pacstrap to fail.
-	# Run sudo pacman -Sy archlinux-keyring on host to fix.
+BASE_PACKAGES = [
+	"base", "linux", "nano",
+	"linux-firmware-amdgpu", "linux-firmware-atheros", "linux-firmware-broadcom", "linux-firmware-cirrus", "linux-firmware-intel", "linux-firmware-mediatek",
+	"linux-firmware-nvidia", "linux-firmware-other", "linux-firmware-radeon", "linux-firmware-realtek", "linux-firmware-liquidio", "linux-firmware-marvell",
+	"linux-firmware-mellanox", "linux-firmware-nfp", "linux-firmware-qcom", "linux-firmware-qlogic",
+]
+INTEGRABOOT_PACKAGES = [ "python", "efibootmgr", "efitools" ]
+SUDO_PACKAGES = [ "sudo" ]
+YAY_PACKAGES = [ "base-devel" ] # Unofficially required by yay-bin
+PLASMA_PACKAGES = [
+	"plasma-desktop", "sddm", "sddm-kcm",
+	"plasma-nm", "plasma-pa", "pipewire-pulse", "wireplumber", "kscreen", "powerdevil", "power-profiles-daemon", "bluedevil",
+]
+APP_PACKAGES = [ "dolphin", "spectacle", "alacritty", "firefox" ]
 
-	# Initialization and scanity checking
-	ignoreScanityFailures = True
-	if os.geteuid() != 0 or os.getegid() != 0:
-		PrintError(f"Root is required to run eos_install. Try sudo eos_install.")
-		if not ignoreScanityFailures:
-			return 1
-	for dep, pac in DEPENDENCIES:
-		if shutil.which(dep) == None:
-			PrintError(f"Unable to locate required dependency {dep}. Try pacman -Syu {pac}.")
-			if not ignoreScanityFailures:
-				return 1
-	if not os.path.ismount("/sys"):
-		PrintError("Nothing is mounted on /sys. eos_install requires SysFs.")
-		if not ignoreScanityFailures:
-			return 1
-	if not os.path.ismount("/proc"):
-		PrintError("Nothing is mounted on /proc. eos_install requires Proc.")
-		if not ignoreScanityFailures:
-			return 1
-	if not os.path.ismount("/dev"):
-		PrintError("Nothing is mounted on /dev. eos_install requires DevTmpFs.")
-		if not ignoreScanityFailures:
-			return 1
-	cpuinfo = ReadFile("/proc/cpuinfo").replace("\t", "")
-	if not "lm" in cpuinfo[cpuinfo.find("\nflags:") + len("\nflags:"):].splitlines()[0].strip().split(" "):
-		PrintError("EpsilonOS requires an x86-64 CPU.")
-		if not ignoreScanityFailures:
-			return 1
-	if ReadFile("/sys/class/tpm/tpm0/tpm_version_major", defaultContents="").strip() != "2":
-		PrintError("EpsilonOS requires a motherboard with a TPM2 chip.")
-		if not ignoreScanityFailures:
-			return 1
-	if not os.path.exists("/sys/firmware/efi"):
-		PrintError("EpsilonOS requires a UEFI motherboard. Double check that your system is not booted in CSM mode.")
-		if not ignoreScanityFailures:
-			return 1
-	if os.path.ismount("/new_root"):
-		PrintError("Something is already mounted at /new_root. Please manually unmount.")
-		if not ignoreScanityFailures:
-			return 1
-	if os.path.isdir("/new_root") and len(os.listdir("/new_root")) != 0:
-		PrintError("/new_root already exists and is not empty. Please manually check.")
-		if not ignoreScanityFailures:
-			return 1
-	if os.path.exists("/dev/mapper/new_cryptroot"):
-		PrintError("Something is already open in cryptsetup as new_cryptroot. Please manually close.")
-		if not ignoreScanityFailures:
-			return 1
-	if RunCommand("ping -c 1 1.1.1.1", check=False) != 0:
-		PrintError("An internet connection is required to run eos_install. You may need to setup WiFi with iwctl.")
-		if not ignoreScanityFailures:
-			return 1
-	print()
-	print("----- EpsilonOS Installer v1.1.0 -----")
-	print()
+# Gathers every package the chosen options need so pacstrap can install them in one transaction.
+# This way databases are synced once and hooks such as mkinitcpio only run once at the end.
+def PlanPackages(CONF):
+	packages = BASE_PACKAGES + INTEGRABOOT_PACKAGES + SUDO_PACKAGES + YAY_PACKAGES
+	if not CONF['tty_only']:
+		packages += PLASMA_PACKAGES + APP_PACKAGES
+	plan = []
+	for package in packages:
+		if not package in plan:
+			plan.append(package)
+	return plan
 
+DEFAULT_PACKAGE_CACHE = "/var/cache/eos_install"
+STAGING_PACKAGE_CACHE = "/tmp/eos_install_cache"
+LOCAL_REPO_NAME = "eos_local"
+PACMAN_CONF_PATH = "/tmp/eos_install_pacman.conf"
 
+# Writes a copy of the host pacman.conf which points CacheDir at the package cache and optionally uses only the local repo.
+# The local repo holds every planned package and its dependencies, so the sync repos are left out and neither pacman -Sy
+# nor pacstrap contacts the mirrors.
+def WritePacmanConf(cacheDir, localRepo):
+	pacmanConf = []
+	section = None
+	for line in ReadFile("/etc/pacman.conf").splitlines():
+		if line.startswith("["):
+			section = line.strip()
+		if localRepo and section != None and section != "[options]":
+			continue
+		pacmanConf.append(line)
+		if line.strip() == "[options]":
+			pacmanConf.append(f"CacheDir = {cacheDir}/")
+	if localRepo:
+		while len(pacmanConf) != 0 and pacmanConf[-1].strip() == "":
+			pacmanConf.pop()
+		pacmanConf += [
+			f"",
+			f"[{LOCAL_REPO_NAME}]",
+			f"SigLevel = Optional TrustedOnly",
+			f"Server = file://{cacheDir}",
+		]
+	pacmanConf = "\n".join(pacmanConf) + "\n"
+	CreateOrWriteFile(PACMAN_CONF_PATH, pacmanConf, 0o644)
+	return PACMAN_CONF_PATH
 
-	# offline.conf template and parsing
-	CONF = {}
-	if not os.path.isfile("./offline.conf"):
-		CreateFile("./offline.conf", DEFAULT_CONF, 0o600)
-		PrintWarning("./offline.conf does not exist in the current working directory so a blank template was created.")
-		PrintWarning("Please fill out each field in ./offline.conf with your desired options and run eos_install again.")
-		print()
-		return 1
-	for line in ReadFile("./offline.conf").splitlines():
+# Lists every package named in installer/packages. Lines are formatted as "name - optional comment".
+def ReadPackagesFile():
+	packages = []
+	for line in ReadFile(os.path.join(GetEnvironmentDir(), "packages")).splitlines():
+		line = line.strip()
 		if line.startswith("#") or line == "":
 			continue
-		elif not "=" in line:
-			PrintError(f"Invalid line in offline.conf: {line}")
-			return 1
-		else:
-			key = line[:line.find("=")].lower()
-			value = line[line.find("=") + 1:]
-			if key in CONF:
-				PrintError(f"{key} was already set in offline.conf: {line}")
-				return 1
-			if not key in CONF_KEYS:
-				PrintError(f"Unknown key in offline.conf: {line}")
-				return 1
-			CONF[key] = value
-	if not "root_drive" in CONF or CONF['root_drive'] == "":
-		PrintError(f"root_drive was not specified in offline.conf.")
+		packages.append(line.split(" ")[0])
+	return packages
+
+# Handles eos_install cache populate and eos_install cache gc.
+def CacheMain(args):
+	if len(args) < 1 or len(args) > 2 or not args[0] in [ "populate", "gc" ]:
+		PrintError("Usage: eos_install cache <populate|gc> [cache_dir]")
 		return 1
-	if RunCommand(f"sh -c \'if [ -b \"{CONF['root_drive']}\" ]; then exit 0; else exit 1; fi\'", check=False) != 0:
-		PrintError(f"root_drive specified in offline.conf was not a valid block device: {CONF['root_drive']}")
+	if os.geteuid() != 0 or os.getegid() != 0:
+		PrintError(f"Root is required to manage the package cache. Try sudo eos_install cache {args[0]}.")
 		return 1
-	if not "pin" in CONF:
-		PrintError(f"pin was not specified in offline.conf.")
+	if shutil.which("repo-add") == None:
+		PrintError(f"Unable to locate required dependency repo-add. Try pacman -Syu pacman.")
 		return 1
-	if not "tty_only" in CONF:
-		CONF['tty_only'] = "True"
-	if "tty_only" in CONF and CONF['tty_only'].lower() == "true":
-		CONF['tty_only'] = True
-	elif "tty_only" in CONF and CONF['tty_only'].lower() == "false":
-		CONF['tty_only'] = False
+	cacheDir = RealPath(args[1] if len(args) == 2 else DEFAULT_PACKAGE_CACHE)
+	# A private empty local database makes pacman resolve and download every dependency, not just the ones missing on this host.
+	dbPath = os.path.join(cacheDir, ".db")
+	RunCommand(f"mkdir -m 755 -p \"{dbPath}/local\"")
+	pacmanFlags = f"--dbpath \"{dbPath}\" --cachedir \"{cacheDir}/\" --noconfirm"
+
+	print("Syncing package databases...")
+	RunCommand(f"pacman -Sy {pacmanFlags}")
+	available = set(RunCommand(f"pacman -Slq {pacmanFlags}", capture=True).splitlines())
+	packages = []
+	for package in PlanPackages({ "tty_only": False }) + ReadPackagesFile():
+		if not package in available:
+			PrintWarning(f"Skipping {package} because it is not in the sync repositories.")
+		elif not package in packages:
+			packages.append(package)
+
+	if args[0] == "populate":
+		print(f"Downloading {len(packages)} packages and their dependencies...")
+		RunCommand(f"pacman -Sw {pacmanFlags} {" ".join(packages)}", echo=True)
+
+	# Every package file which is not part of the current dependency closure is stale. The repo database is always rebuilt.
+	print("Removing stale packages...")
+	current = set([ os.path.basename(url) for url in RunCommand(f"pacman -Sp {pacmanFlags} {" ".join(packages)}", capture=True).splitlines() ])
+	removed = 0
+	for fileName in os.listdir(cacheDir):
+		if fileName.endswith(".pkg.tar.zst.sig"):
+			packageName = fileName[:-len(".sig")]
+		elif fileName.endswith(".pkg.tar.zst") or fileName.startswith(f"{LOCAL_REPO_NAME}."):
+			packageName = fileName
+		else:
+			continue
+		if not packageName in current:
+			os.remove(os.path.join(cacheDir, fileName))
+			removed += 1
+	print(f"Removed {removed} stale files.")
+
+	print(f"Building {LOCAL_REPO_NAME} repository...")
+	packageFiles = [ f"\"{os.path.join(cacheDir, fileName)}\"" for fileName in sorted(os.listdir(cacheDir)) if fileName.endswith(".pkg.tar.zst") ]
+	if len(packageFiles) != 0:
+		RunCommand(f"repo-add -q \"{os.path.join(cacheDir, f"{LOCAL_REPO_NAME}.db.tar.zst")}\" {" ".join(packageFiles)}")
+	print(f"Package cache at {cacheDir} holds {len(packageFiles)} packages.")
+	print()
+	return 0
+
+INSTALLER_VERSION = "1.1.0"
+REPORT_PATH = "/new_root/var/log/eos_install.json"
+
+# Every command and phase is recorded here and saved as a JSON report so installer versions can be compared.
+# Secrets such as the pin and password are only ever passed on stdin, so commands are recorded exactly as they were run.
+REPORT = { "installer_version": INSTALLER_VERSION, "started": time.time(), "drives": [], "phases": [], "commands": [] }
+REPORT_LOCK = threading.Lock()
+CURRENT_PHASE = threading.local()
+
+# Returns the bytes received on every network interface and the bytes written to every drive being installed to.
+def SampleCounters():
+	downloaded = 0
+	for line in ReadFile("/proc/net/dev", defaultContents="").splitlines()[2:]:
+		interface, stats = line.split(":", 1)
+		if interface.strip() != "lo":
+			downloaded += int(stats.split()[0])
+	written = 0
+	for drive in REPORT['drives']:
+		stat = ReadFile(f"/sys/block/{os.path.basename(drive)}/stat", defaultContents="").split()
+		if len(stat) > 6:
+			written += int(stat[6]) * 512
+	return downloaded, written
+
+def RecordCommand(command, returncode, wallTime, cpuTime):
+	with REPORT_LOCK:
+		REPORT['commands'].append({ "phase": getattr(CURRENT_PHASE, "name", None), "command": command, "exit_status": returncode, "wall_time": round(wallTime, 3), "cpu_time": None if cpuTime == None else round(cpuTime, 3) })
+
+# Starts timing a named phase on the calling thread. Any phase already running on this thread is ended first.
+# Downloads and disk writes are sampled system wide, so phases which run at the same time share those counters.
+def StartPhase(name):
+	if getattr(CURRENT_PHASE, "name", None) != None:
+		EndPhase("ok")
+	CURRENT_PHASE.name = name
+	CURRENT_PHASE.startTime = time.monotonic()
+	CURRENT_PHASE.startCounters = SampleCounters()
+def EndPhase(status):
+	downloaded, written = SampleCounters()
+	with REPORT_LOCK:
+		REPORT['phases'].append({
+			"name": CURRENT_PHASE.name,
+			"status": status,
+			"wall_time": round(time.monotonic() - CURRENT_PHASE.startTime, 3),
+			"cpu_time": round(sum([ command['cpu_time'] or 0 for command in REPORT['commands'] if command['phase'] == CURRENT_PHASE.name ]), 3),
+			"bytes_downloaded": downloaded - CURRENT_PHASE.startCounters[0],
+			"bytes_written": written - CURRENT_PHASE.startCounters[1],
+		})
+	CURRENT_PHASE.name = None
+
+def FormatBytes(byteCount):
+	for unit in [ "B", "KiB", "MiB", "GiB" ]:
+		if byteCount < 1024 or unit == "GiB":
+			return f"{byteCount:.0f} {unit}" if unit == "B" else f"{byteCount:.1f} {unit}"
+		byteCount /= 1024
+
+def PrintReport():
+	print(f"{"Phase":<16} {"Wall":>9} {"CPU":>9} {"Downloaded":>11} {"Written":>11}  Status")
+	for phase in REPORT['phases']:
+		print(f"{phase['name']:<16} {phase['wall_time']:>8.1f}s {phase['cpu_time']:>8.1f}s {FormatBytes(phase['bytes_downloaded']):>11} {FormatBytes(phase['bytes_written']):>11}  {phase['status']}")
+	print(f"{"total":<16} {time.time() - REPORT['started']:>8.1f}s {sum([ phase['cpu_time'] for phase in REPORT['phases'] ]):>8.1f}s")
+
+def WriteReport(filePath):
+	report = dict(REPORT)
+	report['finished'] = time.time()
+	contents = json.dumps(report, indent=4) + "\n"
+	CreateOrWriteFile(filePath, contents, 0o644)
+
+# Runs commands inside a new root through one long lived arch-chroot shell.
+# This way the /proc, /sys, /dev and resolv.conf mounts are set up once for the whole install instead of once per command.
+class ChrootSession:
+	def __init__(self, root):
+		self.root = root
+		self.process = None
+		self.marker = f"EOS_CHROOT_STATUS_{secrets.token_hex(8)}:"
+		self.results = []
+	def Open(self):
+		self.process = subprocess.Popen(f"arch-chroot \"{self.root}\" /bin/bash --noprofile --norc", stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True, text=True)
+		# The time keyword reports the CPU time of each command on a marker line of its own.
+		self.process.stdin.write(f"exec 2>&1\nTIMEFORMAT=\"{self.marker}CPU %3U %3S\"\n")
+	def Run(self, command, echo=False, capture=False, check=True, input=None):
+		if echo and capture:
+			raise Exception("Command cannot be run with both echo and capture.")
+		# Each command runs in a subshell with no stdin so it can neither exit the session nor eat the commands after it.
+		# Input is given to it as a quoted here document ending in a line of its own, so it is never part of the recorded command.
+		startTime = time.monotonic()
+		redirect = "</dev/null" if input == None else f"<<\'{self.marker}INPUT\'\n{input}\n{self.marker}INPUT"
+		self.process.stdin.write(f"time (\n{command}\n) {redirect}\necho \"{self.marker}$?\"\n")
+		self.process.stdin.flush()
+		output = ""
+		cpuTime = None
+		returncode = None
+		while returncode == None:
+			line = self.process.stdout.readline()
+			if line == "":
+				raise Exception(f"Chroot session exited unexpectedly.\nCmdLine: {command}\n\n{output}")
+			if self.marker + "CPU " in line:
+				line, cpuTime = line.split(self.marker + "CPU ")
+				cpuTime = sum([ float(seconds) for seconds in cpuTime.split() ])
+			elif self.marker in line:
+				line, returncode = line.split(self.marker)
+				returncode = int(returncode)
+			if echo:
+				print(line, end="", flush=True)
+			output += line
+		self.results.append((command, returncode))
+		RecordCommand(f"arch-chroot {self.root} {command}", returncode, time.monotonic() - startTime, cpuTime)
+		if check and returncode != 0:
+			raise Exception(f"Sub-process returned non-zero exit code.\nExitCode: {returncode}\nCmdLine: arch-chroot {self.root} {command}\n\n{output}")
+		if capture and not check:
+			return output.strip(), returncode
+		elif capture:
+			return output.strip()
+		elif not check:
+			return returncode
+		else:
+			return
+	def Close(self):
+		if self.process == None:
+			return
+		# The session may already have died with the failure being reported, which must not be replaced by a broken pipe.
+		try:
+			if self.process.poll() == None:
+				self.process.stdin.write("exit\n")
+			self.process.stdin.close()
+		except (BrokenPipeError, OSError):
+			pass
+		self.process.wait()
+		self.process.stdout.close()
+		self.process = None
+		failures = [ (command, returncode) for command, returncode in self.results if returncode != 0 ]
+		print(f"Chroot session ran {len(self.results)} commands with {len(failures)} failures.")
+		for command, returncode in failures:
+			PrintWarning(f"Chroot command exited with {returncode}: {command}")
+
+# Returns the chroot session for /new_root and opens it the first time it is needed.
+def Chroot(RUNTIME):
+	if not "chroot" in RUNTIME:
+		RUNTIME['chroot'] = ChrootSession("/new_root")
+		RUNTIME['chroot'].Open()
+	return RUNTIME['chroot']
+
+# Reads the queue limits of a drive from sysfs and derives the partition alignment, mkfs.ext4 geometry,
+# and mount options which give the best throughput for its class of device.
+def ProfileDrive(drive):
+	name = os.path.basename(RealPath(drive))
+	profile = { "drive": drive }
+	for key, default in [ ("rotational", 1), ("logical_block_size", 512), ("physical_block_size", 512), ("minimum_io_size", 512), ("optimal_io_size", 0), ("nr_requests", 0), ("discard_granularity", 0), ("discard_max_bytes", 0) ]:
+		value = ReadFile(f"/sys/block/{name}/queue/{key}", defaultContents="").strip()
+		profile[key] = int(value) if value.isdigit() else default
+	if profile['rotational'] == 1:
+		profile['class'] = "hdd"
+	elif name.startswith("nvme"):
+		profile['class'] = "nvme"
 	else:
-		PrintError(f"tty_only specified in offline.conf must be either True or False: {CONF['tty_only']}")
-		return 1
-	if not "password" in CONF:
-		PrintError(f"password was not specified in offline.conf.")
-		return 1
-	if not "efi_drive" in CONF or CONF['efi_drive'] == "":
-		CONF['efi_drive'] = CONF['root_drive']
-	if RunCommand(f"sh -c \'if [ -b \"{CONF['efi_drive']}\" ]; then exit 0; else exit 1; fi\'", check=False) != 0:
-		PrintError(f"efi_drive specified in offline.conf was not a valid block device: {CONF['efi_drive']}")
-		return 1
-	if not "swap_size" in CONF or CONF['swap_size'] == "":
-		swap_size_set = False
-		for line in ReadFile("/proc/meminfo").splitlines():
-			if line.startswith("MemTotal: "):
-				swap_size_set = True
-				CONF['swap_size'] = f"{int(line.split()[1]) * 1024}"
-				break
-		if not swap_size_set:
-			PrintError(f"Unable to determine MemTotal from /proc/meminfo")
-			return 1
-	try:
-		CONF['swap_size'] = int(CONF['swap_size'])
-		if CONF['swap_size'] < -1:
-			raise Exception()
-	except:
-		PrintError(f"swap_size specified in offline.conf was invalid: {CONF['swap_size']}")
-		return 1
+		profile['class'] = "ssd"
+	# Partitions start on 1 MiB boundaries, widened when the drive reports an optimal IO size 1 MiB is not a multiple of.
+	alignment = 1048576
+	if profile['optimal_io_size'] > 0:
+		alignment = math.lcm(alignment, profile['optimal_io_size'])
+	profile['alignment_sectors'] = alignment // profile['logical_block_size']
+	# Drives which report an optimal IO size larger than a block (RAID, some SSDs) get matching ext4 stride and stripe width.
+	profile['mkfs_options'] = [ "lazy_journal_init" ]
+	if profile['optimal_io_size'] > 4096:
+		profile['mkfs_options'] += [ f"stride={max(1, profile['minimum_io_size'] // 4096)}", f"stripe_width={profile['optimal_io_size'] // 4096}" ]
+	# A large journal turns the scattered metadata writes of a spinning disk into sequential ones.
+	profile['journal_size_mib'] = 1024 if profile['class'] == "hdd" else None
+	# NVMe queues discards next to normal IO so online discard is cheap, as long as the discard granularity is small.
+	# SATA TRIM often stalls the queue so SSDs get a weekly fstrim instead.
+	if profile['discard_max_bytes'] == 0:
+		profile['discard'] = "none"
+	elif profile['class'] == "nvme" and profile['discard_granularity'] <= 1048576:
+		profile['discard'] = "online"
+	else:
+		profile['discard'] = "fstrim"
+	# lazytime keeps timestamp only updates in memory. NVMe flushes are cheap so only slower drives get a longer commit interval.
+	profile['mount_options'] = [ "lazytime" ]
+	if profile['discard'] == "online":
+		profile['mount_options'].append("discard")
+	profile['commit_interval'] = 5 if profile['class'] == "nvme" else 30
+	return profile
 
+# Returns the paths PhasePartitioning gives the EFI partition, the root partition, and the device the root filesystem lives on.
+def PartitionPaths(CONF):
+	efiPart = CONF['efi_drive'] + ("p1" if CONF['efi_drive'][-1].isdigit() else "1")
+	if CONF['efi_drive'] != CONF['root_drive']:
+		rootPart = CONF['root_drive'] + ("p1" if CONF['root_drive'][-1].isdigit() else "1")
+	else:
+		rootPart = CONF['root_drive'] + ("p2" if CONF['root_drive'][-1].isdigit() else "2")
+	return efiPart, rootPart, ("/dev/mapper/new_cryptroot" if CONF['password'] != "" else rootPart)
 
+def MountFilesystems(RUNTIME):
+	RunCommand("mkdir -m 700 -p /new_root/")
+	if not os.path.ismount("/new_root"):
+		RunCommand(f"mount \"{RUNTIME['root_dev']}\" /new_root")
+	RunCommand("mkdir -m 700 -p /new_root/boot/")
+	if not os.path.ismount("/new_root/boot"):
+		RunCommand(f"mount \"{RUNTIME['efi_part']}\" /new_root/boot")
+	RUNTIME['efi_uuid'] = RunCommand(f"blkid -o value -s UUID \"{RUNTIME['efi_part']}\"", capture=True)
+	RUNTIME['root_uuid'] = RunCommand(f"blkid -o value -s UUID \"{RUNTIME['root_dev']}\"", capture=True)
 
-	# Disk, partition, filesystem, and encryption setup
-	RUNTIME = {}
+# A journal of finished phases is kept on the target so a failed install can be continued by running eos_install again.
+JOURNAL_PATH = "/new_root/var/lib/eos_install/journal"
+
+def ConfHash():
+	return hashlib.sha256(ReadFile("./offline.conf", binary=True)).hexdigest()
+
+def WriteJournal(done):
+	if not os.path.ismount("/new_root"):
+		return
+	os.makedirs(os.path.dirname(JOURNAL_PATH), mode=0o700, exist_ok=True)
+	contents = json.dumps({ "conf_hash": ConfHash(), "phases": done }, indent=4) + "\n"
+	CreateOrWriteFile(JOURNAL_PATH, contents, 0o600)
+
+# Opens and mounts the target left behind by an earlier run and returns the phases its journal says are finished.
+# If there is no journal for this offline.conf the target is closed again and an empty list is returned.
+def ResumeInstall(CONF, RUNTIME):
+	if RunCommand(f"sh -c \'if [ -b \"{RUNTIME['root_part']}\" ]; then exit 0; else exit 1; fi\'", check=False) != 0:
+		return []
+	if CONF['password'] != "" and not os.path.exists(RUNTIME['root_dev']):
+		if RunCommand(f"cryptsetup isLuks \"{RUNTIME['root_part']}\"", check=False) != 0:
+			return []
+		if RunCommand(f"cryptsetup open \"{RUNTIME['root_part']}\" new_cryptroot --batch-mode", input=CONF['password'], check=False) != 0:
+			return []
+	journal = None
+	if os.path.ismount("/new_root") or RunCommand(f"mount -o ro \"{RUNTIME['root_dev']}\" /new_root", check=False) == 0:
+		journal = json.loads(ReadFile(JOURNAL_PATH, defaultContents="null"))
+	if journal == None or journal['conf_hash'] != ConfHash():
+		RunCommand("umount -R /new_root", check=False)
+		if CONF['password'] != "":
+			RunCommand("cryptsetup close new_cryptroot", check=False)
+		return []
+	RunCommand("mount -o remount,rw /new_root")
+	MountFilesystems(RUNTIME)
+	return journal['phases']
+
+def PhasePartitioning(CONF, RUNTIME):
 	print("Creating new GPT partition table...")
 	RunCommand(f"wipefs -a \"{CONF['root_drive']}\"")
 	RunCommand(f"sgdisk --clear \"{CONF['root_drive']}\"")
@@ -254,52 +532,127 @@ def Main():
 		RunCommand(f"sgdisk --clear \"{CONF['efi_drive']}\"")
 
 	print("Creating partitions...")
-	RunCommand(f"sgdisk --new=1:0:+512M --typecode=1:EF00 --change-name=1:\"EpsilonOS EFI Partition\" \"{CONF['efi_drive']}\"")
-	RUNTIME['efi_part'] = CONF['efi_drive'] + ("p1" if CONF['efi_drive'][-1].isdigit() else "1")
+	efiProfile = RUNTIME['profiles'][CONF['efi_drive']]
+	rootProfile = RUNTIME['profiles'][CONF['root_drive']]
+	RunCommand(f"sgdisk --set-alignment={efiProfile['alignment_sectors']} --new=1:0:+512M --typecode=1:EF00 --change-name=1:\"EpsilonOS EFI Partition\" \"{CONF['efi_drive']}\"")
 	if CONF['efi_drive'] != CONF['root_drive']:
 		RunCommand(f"partprobe \"{CONF['efi_drive']}\"")
+	# --align-end keeps the root partition a whole number of alignment blocks long, otherwise it runs to the last usable
+	# sector and its size is not a multiple of the 4096 byte LUKS sectors on a 512 byte sector drive.
 	if CONF['efi_drive'] != CONF['root_drive']:
-		RunCommand(f"sgdisk --new=1:0:0 --typecode=1:8309 --change-name=1:\"EpsilonOS Root\" \"{CONF['root_drive']}\"")
-		RUNTIME['root_part'] = CONF['root_drive'] + ("p1" if CONF['root_drive'][-1].isdigit() else "1")
+		RunCommand(f"sgdisk --set-alignment={rootProfile['alignment_sectors']} --align-end --new=1:0:0 --typecode=1:8309 --change-name=1:\"EpsilonOS Root\" \"{CONF['root_drive']}\"")
 	else:
-		RunCommand(f"sgdisk --new=2:0:0 --typecode=2:8309 --change-name=2:\"EpsilonOS Root\" \"{CONF['root_drive']}\"")
-		RUNTIME['root_part'] = CONF['root_drive'] + ("p2" if CONF['root_drive'][-1].isdigit() else "2")
+		RunCommand(f"sgdisk --set-alignment={rootProfile['alignment_sectors']} --align-end --new=2:0:0 --typecode=2:8309 --change-name=2:\"EpsilonOS Root\" \"{CONF['root_drive']}\"")
 	RunCommand(f"partprobe \"{CONF['root_drive']}\"")
-	
+
+LUKS_CIPHERS = [ ("aes-xts-plain64", 512), ("xchacha12,aes-adiantum-plain64", 256) ]
+LUKS_UNLOCK_TARGET_MS = 2000
+
+# Picks the LUKS settings for this machine. The cipher comes from cryptsetup benchmark, since Adiantum beats AES-XTS
+# on CPUs without AES instructions. The workqueue flags come from sysfs, since bypassing the dm-crypt workqueues
+# helps on flash but not on spinning disks. The argon2id cost is chosen so unlocking takes about LUKS_UNLOCK_TARGET_MS.
+def TuneLuks(profile, partSize):
+	tuning = {
+		"partition_size": partSize,
+		"logical_block_size": profile['logical_block_size'],
+		"physical_block_size": profile['physical_block_size'],
+		"rotational": profile['rotational'] == 1,
+		"benchmark": {},
+	}
+	for cipher, keySize in LUKS_CIPHERS:
+		output, returncode = RunCommand(f"cryptsetup benchmark --cipher {cipher} --key-size {keySize}", capture=True, check=False)
+		speeds = output.splitlines()[-1].split() if returncode == 0 and "MiB/s" in output else []
+		speeds = [ float(speeds[i - 1]) for i in range(len(speeds)) if speeds[i] == "MiB/s" ]
+		if len(speeds) == 2:
+			tuning['benchmark'][cipher] = { "key_size": keySize, "encryption_mib_s": speeds[0], "decryption_mib_s": speeds[1] }
+	tuning['cipher'], tuning['key_size'] = LUKS_CIPHERS[0]
+	if len(tuning['benchmark']) != 0:
+		tuning['cipher'] = max(tuning['benchmark'], key=lambda cipher: min(tuning['benchmark'][cipher]['encryption_mib_s'], tuning['benchmark'][cipher]['decryption_mib_s']))
+		tuning['key_size'] = tuning['benchmark'][tuning['cipher']]['key_size']
+	tuning['sector_size'] = max(4096, tuning['logical_block_size'])
+	# cryptsetup refuses a sector size the partition size is not a multiple of.
+	if partSize % tuning['sector_size'] != 0:
+		tuning['sector_size'] = tuning['logical_block_size']
+	tuning['no_workqueue'] = not tuning['rotational']
+	tuning['allow_discards'] = profile['discard'] != "none"
+	memTotal = [ int(line.split()[1]) for line in ReadFile("/proc/meminfo").splitlines() if line.startswith("MemTotal: ") ][0]
+	tuning['pbkdf_memory_kib'] = min(1048576, memTotal // 4)
+	tuning['pbkdf_parallel'] = min(4, os.cpu_count())
+	tuning['iter_time_ms'] = LUKS_UNLOCK_TARGET_MS
+	return tuning
+
+def PhaseEncryption(CONF, RUNTIME):
 	if CONF['password'] != "":
+		print("Benchmarking disk encryption...")
+		rootProfile = RUNTIME['profiles'][CONF['root_drive']]
+		tuning = TuneLuks(rootProfile, int(RunCommand(f"blockdev --getsize64 \"{RUNTIME['root_part']}\"", capture=True)))
+		REPORT['luks'] = tuning
+		print(f"Using {tuning['cipher']} with {tuning['sector_size']} byte sectors.")
 		print("Setting up disk encryption...")
-		RunCommand(f"cryptsetup luksFormat \"{RUNTIME['root_part']}\" --type luks2 --cipher aes-xts-plain64 --force-password --hash sha512 --pbkdf argon2id --use-random --batch-mode", input=CONF['password']) # OPTIONAL: --integrity hmac-sha256
-		RunCommand(f"cryptsetup open \"{RUNTIME['root_part']}\" new_cryptroot --batch-mode", input=CONF['password'])
+		RunCommand(f"cryptsetup luksFormat \"{RUNTIME['root_part']}\" --type luks2 --cipher {tuning['cipher']} --key-size {tuning['key_size']} --sector-size {tuning['sector_size']} --force-password --hash sha512 --pbkdf argon2id --pbkdf-memory {tuning['pbkdf_memory_kib']} --pbkdf-parallel {tuning['pbkdf_parallel']} --iter-time {tuning['iter_time_ms']} --use-random --batch-mode", input=CONF['password']) # OPTIONAL: --integrity hmac-sha256
+		# --persistent stores the performance flags in the LUKS2 header so they also apply when unlocking at boot.
+		# Discards have to be allowed through dm-crypt or the discard options in fstab do nothing.
+		openFlags = ""
+		if tuning['no_workqueue']:
+			openFlags += " --perf-no_read_workqueue --perf-no_write_workqueue"
+		if tuning['allow_discards']:
+			openFlags += " --allow-discards"
+		if openFlags != "":
+			openFlags += " --persistent"
+		RunCommand(f"cryptsetup open \"{RUNTIME['root_part']}\" new_cryptroot{openFlags} --batch-mode", input=CONF['password'])
 
+def PhaseMkfs(CONF, RUNTIME):
 	print("Creating filesystems...")
 	RunCommand(f"mkfs.fat -F32 -n \"EFI\" -S 4096 \"{RUNTIME['efi_part']}\"")
-	if CONF['password'] != "":
-		RunCommand("mkfs.ext4 -q -L \"EOS Root\" -E lazy_journal_init /dev/mapper/new_cryptroot")
-	else:
-		RunCommand(f"mkfs.ext4 -q -L \"EOS Root\" -E lazy_journal_init \"{RUNTIME['root_part']}\"")
+	rootProfile = RUNTIME['profiles'][CONF['root_drive']]
+	journalFlag = "" if rootProfile['journal_size_mib'] == None else f" -J size={rootProfile['journal_size_mib']}"
+	RunCommand(f"mkfs.ext4 -q -L \"EOS Root\" -E {",".join(rootProfile['mkfs_options'])}{journalFlag} \"{RUNTIME['root_dev']}\"")
 
 	print("Mounting filesystems...")
-	RunCommand("mkdir -m 700 -p /new_root/")
-	if CONF['password'] != "":
-		RunCommand("mount /dev/mapper/new_cryptroot /new_root")
-	else:
-		RunCommand(f"mount \"{RUNTIME['root_part']}\" /new_root")
-	RunCommand("mkdir -m 700 -p /new_root/boot/")
-	RunCommand(f"mount \"{RUNTIME['efi_part']}\" /new_root/boot")
+	MountFilesystems(RUNTIME)
 
-	RUNTIME['efi_uuid'] = RunCommand(f"blkid -o value -s UUID \"{RUNTIME['efi_part']}\"", capture=True)
-	if CONF['password'] != "":
-		RUNTIME['root_uuid'] = RunCommand("blkid -o value -s UUID /dev/mapper/new_cryptroot", capture=True)
-	else:
-		RUNTIME['root_uuid'] = RunCommand(f"blkid -o value -s UUID \"{RUNTIME['root_part']}\"", capture=True)
+# Installs from the local repo and runs under eos_bench stay off the network where they can, so they are repeatable
+# and do not touch the mirrorlist of the host.
+def Offline(CONF):
+	return CONF['local_repo'] or os.environ.get("EOS_INSTALL_BENCH", "") != ""
 
+def PhaseMirrors(CONF, RUNTIME):
+	# Rank mirrors for the host before anything is downloaded. pacstrap copies the host mirrorlist to the target.
+	if Offline(CONF):
+		print("Skipping mirror ranking since the mirrors are not used.")
+		return
+	print("Ranking mirrors in the background...")
+	# The installed eos_mirrors is preferred and the copy next to the installer is only there when running from a checkout.
+	mirrorsCommand = "eos_mirrors" if shutil.which("eos_mirrors") != None else f"python \"{os.path.join(GetEnvironmentDir(), "..", "os_scripts", "eos_mirrors.py")}\""
+	if RunCommand(mirrorsCommand, check=False) != 0:
+		PrintWarning("Ranking mirrors failed so the existing mirrorlist will be used.")
+
+def PhasePrefetch(CONF, RUNTIME):
+	# Download every planned package into the package cache while the disk is being prepared
+	pacmanConf = WritePacmanConf(CONF['package_cache'], CONF['local_repo'])
+	packages = PlanPackages(CONF)
+	# A private empty local database makes pacman download every dependency, not just the ones missing on this host.
+	dbPath = os.path.join(CONF['package_cache'], ".db")
+	print(f"Prefetching {len(packages)} planned packages in the background...")
+	try:
+		RunCommand(f"mkdir -m 755 -p \"{dbPath}/local\"")
+		RunCommand(f"pacman -Syw --config \"{pacmanConf}\" --dbpath \"{dbPath}\" --noconfirm {" ".join(packages)}")
+	except Exception as exception:
+		PrintWarning(f"Prefetching packages failed so pacstrap will download them instead.\n{exception}")
+		return
+	print("Finished prefetching packages.")
 
-		
-	# Pacstrap base system install
-	print("Installing base system...")
-	RunCommand("pacstrap /new_root base linux linux-firmware-amdgpu linux-firmware-atheros linux-firmware-broadcom linux-firmware-cirrus linux-firmware-intel linux-firmware-mediatek linux-firmware-nvidia linux-firmware-other linux-firmware-radeon linux-firmware-realtek linux-firmware-liquidio linux-firmware-marvell linux-firmware-mellanox linux-firmware-nfp linux-firmware-qcom linux-firmware-qlogic nano --noconfirm", echo=True)
+def PhasePacstrap(CONF, RUNTIME):
+	# Pacstrap every planned package in one transaction from the cache warmed by PhasePrefetch
+	packages = PlanPackages(CONF)
+	print(f"Installing {len(packages)} planned packages...")
+	# -c makes pacstrap use the CacheDir from our pacman.conf instead of the empty cache on the target.
+	# --needed lets a resumed install skip whatever an interrupted pacstrap already installed.
+	pacmanConf = WritePacmanConf(CONF['package_cache'], CONF['local_repo'])
+	RunCommand(f"pacstrap -c -C \"{pacmanConf}\" /new_root {" ".join(packages)} --needed --noconfirm", echo=True)
 	print()
 
+def PhaseSwap(CONF, RUNTIME):
 	# Mkswap
 	if CONF['swap_size'] != 0:
 		print(f"Creating swapfile with size {CONF['swap_size']} bytes...")
@@ -307,15 +660,19 @@ def Main():
 		RunCommand("chmod 600 /new_root/swapfile")
 		RunCommand("mkswap /new_root/swapfile")
 
+def PhaseFstab(CONF, RUNTIME):
 	# Genfstab
 	print(f"Generating fstab...")
-	eosDriveSupportsTrim = ReadFile(f"/sys/block/{os.path.basename(CONF['root_drive'])}/queue/discard_max_bytes").strip() != "0"
+	rootProfile = RUNTIME['profiles'][CONF['root_drive']]
+	efiProfile = RUNTIME['profiles'][CONF['efi_drive']]
+	rootOptions = "".join([ f",{option}" for option in rootProfile['mount_options'] + [ f"commit={rootProfile['commit_interval']}" ] ])
+	efiOptions = "".join([ f",{option}" for option in efiProfile['mount_options'] ])
 	fstab = "\n".join([
 		f"# EpsilonOS Root",
-		f"UUID={RUNTIME['root_uuid']} / ext4 rw,noatime,errors=remount-ro{",discard" if eosDriveSupportsTrim else ""} 0 1",
+		f"UUID={RUNTIME['root_uuid']} / ext4 rw,noatime,errors=remount-ro{rootOptions} 0 1",
 		f"",
 		f"# EpsilonOS EFI Partition",
-		f"UUID={RUNTIME['efi_uuid']} /boot vfat rw,noatime,errors=remount-ro,uid=0,gid=0,dmask=0077,fmask=0177,codepage=437,iocharset=ascii,shortname=mixed,utf8{",discard" if eosDriveSupportsTrim else ""} 0 2",
+		f"UUID={RUNTIME['efi_uuid']} /boot vfat rw,noatime,errors=remount-ro,uid=0,gid=0,dmask=0077,fmask=0177,codepage=437,iocharset=ascii,shortname=mixed,utf8{efiOptions} 0 2",
 	]) + "\n"
 	if os.path.exists("/new_root/swapfile"):
 		fstab += "\n".join([
@@ -324,24 +681,85 @@ def Main():
 			f"/swapfile swap swap sw 0 0",
 		]) + "\n"
 	WriteFile("/new_root/etc/fstab", fstab)
+	if rootProfile['discard'] == "fstrim" or efiProfile['discard'] == "fstrim":
+		Chroot(RUNTIME).Run("systemctl enable fstrim.timer")
 	print()
 
-	# Install IntegraBoot
+# Downloaded and built files such as integraboot and the yay-bin package are kept in the package cache under their sha256.
+# They are verified on every use and only fetched or built again when the upstream version changes.
+INTEGRABOOT_RELEASES = "https://github.com/FinlayTheBerry/IntegraBoot/releases"
+
+def HashFile(filePath):
+	with open(filePath, "rb") as f:
+		return hashlib.file_digest(f, "sha256").hexdigest()
+
+# Returns the latest upstream version from a JSON api, or None when it can't be reached so the cached artifact is used.
+def UpstreamVersion(url, key):
+	output, returncode = RunCommand(f"curl -fsSL \"{url}\"", capture=True, check=False)
+	try:
+		value = json.loads(output)
+		for part in key:
+			value = value[part]
+		return str(value)
+	except:
+		PrintWarning(f"Unable to check the upstream version at {url}.")
+		return None
+
+# Returns the path of a verified artifact along with its index entry. build(filePath) is called to produce the artifact
+# at filePath when the store has no copy of this version, and returns the file name the artifact should be installed as.
+def LoadArtifact(CONF, name, version, build):
+	storeDir = os.path.join(CONF['package_cache'], "artifacts")
+	os.makedirs(os.path.join(storeDir, "objects"), mode=0o755, exist_ok=True)
+	indexPath = os.path.join(storeDir, "index.json")
+	index = json.loads(ReadFile(indexPath, defaultContents="{}"))
+	entry = index.get(name)
+	if entry != None and (version == None or entry['version'] == version):
+		objectPath = os.path.join(storeDir, "objects", entry['sha256'])
+		if os.path.isfile(objectPath) and HashFile(objectPath) == entry['sha256']:
+			print(f"Using cached {name} {entry['version']}.")
+			return objectPath, entry
+		PrintWarning(f"Cached {name} failed checksum verification so it will be fetched again.")
+	tempPath = os.path.join(storeDir, "objects", f".{name}.tmp")
+	fileName = build(tempPath)
+	digest = HashFile(tempPath)
+	objectPath = os.path.join(storeDir, "objects", digest)
+	os.replace(tempPath, objectPath)
+	index[name] = { "version": "unknown" if version == None else version, "sha256": digest, "file_name": fileName, "stored": time.time() }
+	CreateOrWriteFile(indexPath, json.dumps(index, indent=4) + "\n", 0o644)
+	# Objects no longer referenced by the index belong to outdated versions.
+	for objectName in os.listdir(os.path.join(storeDir, "objects")):
+		if not objectName.startswith(".") and not objectName in [ entry['sha256'] for entry in index.values() ]:
+			os.remove(os.path.join(storeDir, "objects", objectName))
+	return objectPath, index[name]
+
+def InstallIntegraBootFiles(CONF):
+	version = None if Offline(CONF) else UpstreamVersion("https://api.github.com/repos/FinlayTheBerry/IntegraBoot/releases/latest", [ "tag_name" ])
+	releaseUrl = f"{INTEGRABOOT_RELEASES}/latest/download" if version == None else f"{INTEGRABOOT_RELEASES}/download/{version}"
+	for fileName, targetPath, mode in [ ("integraboot.py", "/new_root/usr/bin/integraboot", 0o755), ("integrastub.efi", "/new_root/var/lib/integraboot/integrastub.efi", 0o400) ]:
+		def Download(tempPath):
+			RunCommand(f"curl -fL {releaseUrl}/{fileName} -o \"{tempPath}\"")
+			return fileName
+		objectPath, entry = LoadArtifact(CONF, fileName, version, Download)
+		RunCommand(f"mkdir -m 700 -p \"{os.path.dirname(targetPath)}\"")
+		shutil.copyfile(objectPath, targetPath)
+		os.chmod(targetPath, mode)
+
+def PhaseIntegraBootFiles(CONF, RUNTIME):
+	# Install integraboot.py and integrastub.efi from the artifact store
 	print("Installing IntegraBoot...")
-	# Install IntegraBoot deps
-	RunCommand("pacstrap /new_root python efibootmgr efitools --noconfirm", echo=True)
-	# Install integraboot.py and integrastub.efi from GitHub
-	RunCommand("curl -L https://github.com/FinlayTheBerry/IntegraBoot/releases/latest/download/integraboot.py -o /new_root/usr/bin/integraboot")
-	RunCommand("chmod 755 /new_root/usr/bin/integraboot")
-	RunCommand("mkdir -m 700 -p /new_root/var/lib/integraboot")
-	RunCommand("curl -L https://github.com/FinlayTheBerry/IntegraBoot/releases/latest/download/integrastub.efi -o /new_root/var/lib/integraboot/integrastub.efi")
-	RunCommand("chmod 400 /new_root/var/lib/integraboot/integrastub.efi")
-	# Run IntegraBoot
-	RunCommand("arch-chroot /new_root integraboot", echo=True)
+	InstallIntegraBootFiles(CONF)
+	print()
+
+def PhaseIntegraBootRun(CONF, RUNTIME):
+	# Run IntegraBoot, except under eos_bench where it would add boot entries for loop devices to the host firmware
+	if os.environ.get("EOS_INSTALL_BENCH", "") != "":
+		PrintWarning("Skipping the IntegraBoot run because EOS_INSTALL_BENCH is set.")
+		return
+	Chroot(RUNTIME).Run("integraboot", echo=True)
 	print()
 
-	# Install sudo and setup sudoers file and faillock.conf
-	RunCommand("pacstrap /new_root sudo --noconfirm", echo=True)
+def PhaseUsers(CONF, RUNTIME):
+	# Setup sudoers file and faillock.conf
 	sudoers = "\n".join([
 		f"Defaults!/usr/bin/visudo env_keep += \"SUDO_EDITOR EDITOR VISUAL\"",
 		f"Defaults secure_path=\"/usr/local/sbin:/usr/local/bin:/usr/bin\"",
@@ -354,32 +772,46 @@ def Main():
 	WriteFile("/new_root/etc/security/faillock.conf", "nodelay")
 
 	# Setup root and epsilon users
-	RunCommand(f"arch-chroot /new_root usermod -p \'!*\' root")
-	RunCommand(f"arch-chroot /new_root usermod -s /usr/bin/nologin root")
-	RunCommand(f"arch-chroot /new_root useradd -m -G wheel -c Epsilon epsilon")
-	RunCommand(f"arch-chroot /new_root chage -m -1 -M -1 -W -1 -I -1 -E \"\" epsilon")
+	Chroot(RUNTIME).Run(f"usermod -p \'!*\' root")
+	Chroot(RUNTIME).Run(f"usermod -s /usr/bin/nologin root")
+	if Chroot(RUNTIME).Run("id epsilon", check=False) != 0:
+		Chroot(RUNTIME).Run(f"useradd -m -G wheel -c Epsilon epsilon")
+	Chroot(RUNTIME).Run(f"chage -m -1 -M -1 -W -1 -I -1 -E \"\" epsilon")
+
+def PhasePin(CONF, RUNTIME):
+	# Set the pin of the epsilon user
 	if CONF['pin'] != "":
-		RunCommand(f"arch-chroot /new_root bash -c \'echo \'\\\'\'epsilon:{CONF['pin'].replace("\'", "\'\\\'\'")}\'\\\'\' | chpasswd\'")
+		Chroot(RUNTIME).Run(f"chpasswd", input=f"epsilon:{CONF['pin']}")
 	else:
-		RunCommand(f"arch-chroot /new_root passwd -d epsilon")
+		Chroot(RUNTIME).Run(f"passwd -d epsilon")
+
+# Builds yay-bin with makepkg as epsilon inside the target and moves the package to filePath.
+def BuildYayBin(RUNTIME, filePath):
+	Chroot(RUNTIME).Run("rm -rf /home/epsilon/yay-bin")
+	Chroot(RUNTIME).Run("sudo -u epsilon mkdir -m 700 /home/epsilon/yay-bin")
+	Chroot(RUNTIME).Run("sudo -u epsilon curl https://aur.archlinux.org/cgit/aur.git/plain/PKGBUILD?h=yay-bin -o /home/epsilon/yay-bin/PKGBUILD")
+	Chroot(RUNTIME).Run("sudo -u epsilon sh -c \'cd /home/epsilon/yay-bin && makepkg --nodeps\'")
+	packagePath = [ path for path in glob.glob("/new_root/home/epsilon/yay-bin/yay-bin-*.pkg.tar.zst") if not "yay-bin-debug-" in path ][0]
+	shutil.copyfile(packagePath, filePath)
+	Chroot(RUNTIME).Run("rm -rf /home/epsilon/yay-bin")
+	return os.path.basename(packagePath)
 
-	# Install yay-bin
-	RunCommand("pacstrap /new_root base-devel --noconfirm", echo=True)
-	RunCommand("arch-chroot /new_root sudo -u epsilon mkdir -m 700 /home/epsilon/yay-bin")
-	RunCommand("arch-chroot /new_root sudo -u epsilon curl https://aur.archlinux.org/cgit/aur.git/plain/PKGBUILD?h=yay-bin -o /home/epsilon/yay-bin/PKGBUILD")
-	RunCommand("arch-chroot /new_root sudo -u epsilon sh -c \'cd /home/epsilon/yay-bin && makepkg --nodeps\'")
-	RunCommand("arch-chroot /new_root sudo -u epsilon sh -c \'rm /home/epsilon/yay-bin/yay-bin-debug-*.pkg.tar.zst\'")
-	RunCommand("arch-chroot /new_root sh -c \'pacman -U --noconfirm --needed /home/epsilon/yay-bin/yay-bin-*.pkg.tar.zst\'", echo=True)
-	RunCommand("arch-chroot /new_root sudo -u epsilon rm -rf /home/epsilon/yay-bin")
+def PhaseYayBin(CONF, RUNTIME):
+	# Install yay-bin from the artifact store, only building it when the AUR has a new version
+	version = None if Offline(CONF) else UpstreamVersion("https://aur.archlinux.org/rpc/v5/info?arg[]=yay-bin", [ "results", 0, "Version" ])
+	objectPath, entry = LoadArtifact(CONF, "yay-bin", version, lambda tempPath: BuildYayBin(RUNTIME, tempPath))
+	shutil.copyfile(objectPath, f"/new_root/var/cache/pacman/pkg/{entry['file_name']}")
+	Chroot(RUNTIME).Run(f"pacman -U --noconfirm --needed /var/cache/pacman/pkg/{entry['file_name']}", echo=True)
 
+def PhaseSystem(CONF, RUNTIME):
 	# Set hostname
-	CreateFile("/new_root/etc/hostname", "EpsilonOS", 0o644)
+	CreateOrWriteFile("/new_root/etc/hostname", "EpsilonOS", 0o644)
 	
 	# Set default target to multi user target
-	RunCommand("arch-chroot /new_root systemctl set-default multi-user.target")
+	Chroot(RUNTIME).Run("systemctl set-default multi-user.target")
 
 	# Setup networkd
-	RunCommand("arch-chroot /new_root systemctl enable systemd-networkd.service")
+	Chroot(RUNTIME).Run("systemctl enable systemd-networkd.service")
 	DefaultDotNetwork = "\n".join([
 		f"[Match]",
 		f"Name=en* wl* ww*",
@@ -395,10 +827,10 @@ def Main():
 		f"UseDomains=no",
 		f"UseRoutes=yes",
 	]) + "\n"
-	CreateFile("/new_root/etc/systemd/network/default.network", DefaultDotNetwork, 0o644)
+	CreateOrWriteFile("/new_root/etc/systemd/network/default.network", DefaultDotNetwork, 0o644)
 
 	# Setup resolved
-	RunCommand("arch-chroot /new_root systemctl enable systemd-resolved.service")
+	Chroot(RUNTIME).Run("systemctl enable systemd-resolved.service")
 	ResolvedDotConf = "\n".join([
 		"[Resolve]",
 		"DNS=1.1.1.1#cloudflare-dns.com 1.0.0.1#cloudflare-dns.com 2606:4700:4700::1111#cloudflare-dns.com 2606:4700:4700::1001#cloudflare-dns.com",
@@ -418,65 +850,438 @@ def Main():
 
 	# Set locale
 	WriteFile("/new_root/etc/locale.gen", "en_US.UTF-8 UTF-8")
-	RunCommand(f"arch-chroot /new_root locale-gen")
-	CreateFile("/new_root/etc/locale.conf", "LANG=en_US.UTF-8", 0o644)
+	Chroot(RUNTIME).Run(f"locale-gen")
+	CreateOrWriteFile("/new_root/etc/locale.conf", "LANG=en_US.UTF-8", 0o644)
 
 	# Enable to systemd timesync service and update the time
-	RunCommand("arch-chroot /new_root systemctl enable systemd-timesyncd")
-	RunCommand("arch-chroot /new_root timedatectl set-timezone America/Los_Angeles")
-	RunCommand("arch-chroot /new_root timedatectl set-local-rtc 0")
+	Chroot(RUNTIME).Run("systemctl enable systemd-timesyncd")
+	Chroot(RUNTIME).Run("timedatectl set-timezone America/Los_Angeles")
+	Chroot(RUNTIME).Run("timedatectl set-local-rtc 0")
 
-	# Enable auto login on getty@tty1
+def PhaseAutologin(CONF, RUNTIME):
+	# Enable auto login on getty@tty1 when the drive is already protected by the encryption password
 	if CONF['password'] != "":
 		GettyEpsilonOSDotConf = "\n".join([
 			"[Service]",
 			"ExecStart=",
 			"ExecStart=-/bin/sh -c \'if [ ! -e /run/getty_autologin_done ]; then touch /run/getty_autologin_done; exec /usr/bin/agetty --noreset --noclear --autologin epsilon - ${TERM}; else exec /usr/bin/agetty --noreset --noclear - ${TERM}; fi\'",
 		]) + "\n"
-		RunCommand("mkdir -m 755 /new_root/etc/systemd/system/getty@tty1.service.d/")
-		CreateFile("/new_root/etc/systemd/system/getty@tty1.service.d/EpsilonOS.conf", GettyEpsilonOSDotConf, 0o644)
+		RunCommand("mkdir -m 755 -p /new_root/etc/systemd/system/getty@tty1.service.d/")
+		CreateOrWriteFile("/new_root/etc/systemd/system/getty@tty1.service.d/EpsilonOS.conf", GettyEpsilonOSDotConf, 0o644)
 
-	if not CONF['tty_only']:
-		# TTYS=$(busybox ls /dev/tty* | busybox grep -E '^/dev/tty[0-9]+$'); for tty in $TTYS; do /usr/bin/setleds -D +num -caps -scroll < $tty; done
-		
-		# Install KDE Plasma
-		RunCommand("pacstrap /new_root plasma-desktop sddm sddm-kcm --noconfirm", echo=True)
-
-		RunCommand("arch-chroot /new_root systemctl enable sddm.service")
-		RunCommand("mkdir -m 755 -p /new_root/etc/sddm.conf.d")
-		SDDMEpsilonOSDotConf = "\n".join([
-			f"[General]",
-			f"Numlock=on",
-			f"",
-			f"[Autologin]",
-			f"Relogin=false",
-			f"User=epsilon",
-			f"Session=plasma",
-			f"",
-			f"[Theme]",
-			f"Current=breeze",
-			f"CursorTheme=breeze_cursors",
-			f"Font=Noto Sans,10,-1,0,400,0,0,0,0,0,0,0,0,0,0,1",
-		]) + "\n"
-		CreateFile("/new_root/etc/sddm.conf.d/EpsilonOS.conf", SDDMEpsilonOSDotConf, 0o644)
+def PhaseDesktop(CONF, RUNTIME):
+	if CONF['tty_only']:
+		return
 
-		RunCommand("pacstrap /new_root plasma-nm plasma-pa pipewire-pulse wireplumber kscreen powerdevil power-profiles-daemon bluedevil --noconfirm", echo=True)
-		RunCommand("arch-chroot /new_root systemctl enable NetworkManager")
+	# TTYS=$(busybox ls /dev/tty* | busybox grep -E '^/dev/tty[0-9]+$'); for tty in $TTYS; do /usr/bin/setleds -D +num -caps -scroll < $tty; done
+	
+	# Setup KDE Plasma
+	Chroot(RUNTIME).Run("systemctl enable sddm.service")
+	RunCommand("mkdir -m 755 -p /new_root/etc/sddm.conf.d")
+	SDDMEpsilonOSDotConf = "\n".join([
+		f"[General]",
+		f"Numlock=on",
+		f"",
+		f"[Autologin]",
+		f"Relogin=false",
+		f"User=epsilon",
+		f"Session=plasma",
+		f"",
+		f"[Theme]",
+		f"Current=breeze",
+		f"CursorTheme=breeze_cursors",
+		f"Font=Noto Sans,10,-1,0,400,0,0,0,0,0,0,0,0,0,0,1",
+	]) + "\n"
+	CreateOrWriteFile("/new_root/etc/sddm.conf.d/EpsilonOS.conf", SDDMEpsilonOSDotConf, 0o644)
+
+	Chroot(RUNTIME).Run("systemctl enable NetworkManager")
 
-		RunCommand("arch-chroot /new_root systemctl enable --global pipewire pipewire-pulse wireplumber")
-		RunCommand("arch-chroot /new_root systemctl enable power-profiles-daemon")
-		RunCommand("arch-chroot /new_root systemctl enable bluetooth")
+	Chroot(RUNTIME).Run("systemctl enable --global pipewire pipewire-pulse wireplumber")
+	Chroot(RUNTIME).Run("systemctl enable power-profiles-daemon")
+	Chroot(RUNTIME).Run("systemctl enable bluetooth")
 
-		RunCommand("pacstrap /new_root dolphin spectacle alacritty firefox --noconfirm", echo=True)
-		
-		# Set the default target to the graphical target
-		RunCommand("arch-chroot /new_root systemctl set-default graphical.target")
+	# Set the default target to the graphical target
+	Chroot(RUNTIME).Run("systemctl set-default graphical.target")
 
-	# Unmount /new_root
+def PhaseUnmount(CONF, RUNTIME):
+	# Close the chroot session, save the install report, and unmount /new_root
+	if "chroot" in RUNTIME:
+		RUNTIME.pop("chroot").Close()
+	WriteReport(REPORT_PATH)
+	os.remove(JOURNAL_PATH)
 	RunCommand("umount -R /new_root")
 	if CONF['password'] != "":
 		RunCommand("cryptsetup close new_cryptroot")
 
+# Golden images are a tarball of everything the installer produces which does not depend on the machine.
+# eos_install golden builds one in GOLDEN_BUILD_DIR and golden_image= in offline.conf deploys it.
+GOLDEN_BUILD_DIR = "/var/tmp/eos_golden"
+GOLDEN_EXCLUDES = [ "./var/lib/eos_install", "./etc/pacman.d/gnupg", "./swapfile" ]
+# /boot is the vfat ESP on deployed machines, which cannot hold owners, modes, ACLs or xattrs, so its contents are
+# packed here instead and copied onto the ESP without them after extraction.
+GOLDEN_BOOT_DIR = "/var/lib/eos_golden_boot"
+
+def PhaseGoldenImage(CONF, RUNTIME):
+	# Close the chroot session and pack /new_root into the golden image
+	if "chroot" in RUNTIME:
+		RUNTIME.pop("chroot").Close()
+	print(f"Packing golden image {RUNTIME['golden_image']}...")
+	# Every deployed machine must generate its own machine-id on first boot.
+	WriteFile("/new_root/etc/machine-id", "uninitialized\n")
+	RunCommand(f"mv /new_root/boot \"/new_root{GOLDEN_BOOT_DIR}\"")
+	RunCommand("mkdir -m 700 /new_root/boot")
+	excludes = " ".join([ f"--exclude=\"{exclude}\"" for exclude in GOLDEN_EXCLUDES ])
+	RunCommand(f"tar -I \"zstd -T0 -19\" -cpf \"{RUNTIME['golden_image']}\" --xattrs --xattrs-include=\'*\' --acls --numeric-owner {excludes} -C /new_root .")
+	RunCommand("umount -R /new_root")
+	RunCommand(f"rm -rf \"{GOLDEN_BUILD_DIR}\"")
+	print()
+
+def PhaseGoldenExtract(CONF, RUNTIME):
+	# Stream the golden image onto the freshly made filesystem
+	print(f"Extracting golden image {CONF['golden_image']}...")
+	if CONF['golden_image'].startswith(("http://", "https://")):
+		source = f"curl -fsSL \"{CONF['golden_image']}\" | "
+		imagePath = "-"
+	else:
+		source = ""
+		imagePath = CONF['golden_image']
+	RunCommand(f"set -o pipefail; {source}tar -I zstd -xpf \"{imagePath}\" --xattrs --xattrs-include=\'*\' --acls --numeric-owner --exclude=./boot -C /new_root")
+	RunCommand(f"cp -r --no-preserve=mode,ownership,timestamps \"/new_root{GOLDEN_BOOT_DIR}/.\" /new_root/boot/")
+	RunCommand(f"rm -rf \"/new_root{GOLDEN_BOOT_DIR}\"")
+	# The pacman keyring holds a private key so each machine gets its own.
+	Chroot(RUNTIME).Run("pacman-key --init")
+	Chroot(RUNTIME).Run("pacman-key --populate archlinux")
+	print()
+
+# Phases are listed as (name, dependencies, function) and each function is called with CONF and RUNTIME.
+def InstallPhases(CONF):
+	if CONF['golden_image'] != "":
+		return DeployPhases()
+	return [
+		("partitioning", [], PhasePartitioning),
+		("encryption", [ "partitioning" ], PhaseEncryption),
+		("mkfs", [ "encryption" ], PhaseMkfs),
+		("mirrors", [], PhaseMirrors),
+		("prefetch", [ "mirrors" ], PhasePrefetch),
+		("pacstrap", [ "mkfs", "prefetch" ], PhasePacstrap),
+		("swap", [ "pacstrap" ], PhaseSwap),
+		("fstab", [ "swap" ], PhaseFstab),
+		("integraboot", [ "fstab" ], PhaseIntegraBootFiles),
+		("integraboot-run", [ "integraboot" ], PhaseIntegraBootRun),
+		("users", [ "integraboot-run" ], PhaseUsers),
+		("pin", [ "users" ], PhasePin),
+		("yay-bin", [ "pin" ], PhaseYayBin),
+		("system", [ "yay-bin" ], PhaseSystem),
+		("autologin", [ "system" ], PhaseAutologin),
+		("desktop", [ "autologin" ], PhaseDesktop),
+		("unmount", [ "desktop" ], PhaseUnmount),
+	]
+
+# Everything which does not depend on the machine, packed into a golden image at the end.
+def GoldenPhases():
+	return [
+		("mirrors", [], PhaseMirrors),
+		("prefetch", [ "mirrors" ], PhasePrefetch),
+		("pacstrap", [ "prefetch" ], PhasePacstrap),
+		("integraboot", [ "pacstrap" ], PhaseIntegraBootFiles),
+		("users", [ "integraboot" ], PhaseUsers),
+		("yay-bin", [ "users" ], PhaseYayBin),
+		("system", [ "yay-bin" ], PhaseSystem),
+		("desktop", [ "system" ], PhaseDesktop),
+		("image", [ "desktop" ], PhaseGoldenImage),
+	]
+
+# Only the per machine steps, run after the golden image is extracted onto the new drive.
+def DeployPhases():
+	return [
+		("partitioning", [], PhasePartitioning),
+		("encryption", [ "partitioning" ], PhaseEncryption),
+		("mkfs", [ "encryption" ], PhaseMkfs),
+		("extract", [ "mkfs" ], PhaseGoldenExtract),
+		("swap", [ "extract" ], PhaseSwap),
+		("fstab", [ "swap" ], PhaseFstab),
+		("pin", [ "fstab" ], PhasePin),
+		("autologin", [ "pin" ], PhaseAutologin),
+		("integraboot", [ "autologin" ], PhaseIntegraBootRun),
+		("unmount", [ "integraboot" ], PhaseUnmount),
+	]
+
+def RunPhase(name, func, CONF, RUNTIME):
+	StartPhase(name)
+	try:
+		func(CONF, RUNTIME)
+	except:
+		EndPhase("failed")
+		raise
+	EndPhase("ok")
+
+# Starts each phase as soon as every phase it depends on has finished.
+# Phases which do not depend on each other run at the same time, so downloads overlap disk preparation.
+def RunPhases(phases, CONF, RUNTIME, done=None):
+	names = [ name for name, deps, func in phases ]
+	for name, deps, func in phases:
+		for dep in deps:
+			if not dep in names:
+				raise Exception(f"Phase {name} depends on unknown phase {dep}.")
+	if done == None:
+		done = []
+	done = [ name for name in done if name in names ]
+	for name in done:
+		print(f"Skipping {name} because it finished in a previous run.")
+	running = {}
+	with concurrent.futures.ThreadPoolExecutor(max_workers=len(phases)) as executor:
+		while len(done) != len(phases):
+			for name, deps, func in phases:
+				if not name in done and not name in running.values() and all([ dep in done for dep in deps ]):
+					running[executor.submit(RunPhase, name, func, CONF, RUNTIME)] = name
+			if len(running) == 0:
+				raise Exception("Phase dependencies contain a cycle.")
+			finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in finished:
+				name = running.pop(future)
+				future.result()
+				done.append(name)
+				if name != "unmount":
+					WriteJournal(done)
+
+# Parses ./offline.conf, creating a blank template if it does not exist. Returns None if it is invalid.
+# When machine is False only the options which golden images depend on are required.
+def ParseConf(machine):
+	CONF = {}
+	if not os.path.isfile("./offline.conf"):
+		CreateFile("./offline.conf", DEFAULT_CONF, 0o600)
+		PrintWarning("./offline.conf does not exist in the current working directory so a blank template was created.")
+		PrintWarning("Please fill out each field in ./offline.conf with your desired options and run eos_install again.")
+		print()
+		return None
+	for line in ReadFile("./offline.conf").splitlines():
+		if line.startswith("#") or line == "":
+			continue
+		elif not "=" in line:
+			PrintError(f"Invalid line in offline.conf: {line}")
+			return None
+		else:
+			key = line[:line.find("=")].lower()
+			value = line[line.find("=") + 1:]
+			if key in CONF:
+				PrintError(f"{key} was already set in offline.conf: {line}")
+				return None
+			if not key in CONF_KEYS:
+				PrintError(f"Unknown key in offline.conf: {line}")
+				return None
+			CONF[key] = value
+	if not "tty_only" in CONF:
+		CONF['tty_only'] = "True"
+	if "tty_only" in CONF and CONF['tty_only'].lower() == "true":
+		CONF['tty_only'] = True
+	elif "tty_only" in CONF and CONF['tty_only'].lower() == "false":
+		CONF['tty_only'] = False
+	else:
+		PrintError(f"tty_only specified in offline.conf must be either True or False: {CONF['tty_only']}")
+		return None
+	if not "package_cache" in CONF or CONF['package_cache'] == "":
+		CONF['package_cache'] = STAGING_PACKAGE_CACHE
+	CONF['package_cache'] = RealPath(CONF['package_cache'])
+	RunCommand(f"mkdir -m 755 -p \"{CONF['package_cache']}\"")
+	if not "local_repo" in CONF or CONF['local_repo'].lower() == "false":
+		CONF['local_repo'] = False
+	elif CONF['local_repo'].lower() == "true":
+		CONF['local_repo'] = True
+	else:
+		PrintError(f"local_repo specified in offline.conf must be either True or False: {CONF['local_repo']}")
+		return None
+	if CONF['local_repo'] and not os.path.isfile(os.path.join(CONF['package_cache'], f"{LOCAL_REPO_NAME}.db")):
+		PrintError(f"local_repo=True requires a package_cache populated with eos_install cache populate.")
+		return None
+	if not "golden_image" in CONF:
+		CONF['golden_image'] = ""
+	if CONF['golden_image'] != "" and not CONF['golden_image'].startswith(("http://", "https://")) and not os.path.isfile(CONF['golden_image']):
+		PrintError(f"golden_image specified in offline.conf does not exist: {CONF['golden_image']}")
+		return None
+	# Everything below only matters when installing to a machine, not when building a golden image.
+	if not machine:
+		return CONF
+	if not "root_drive" in CONF or CONF['root_drive'] == "":
+		PrintError(f"root_drive was not specified in offline.conf.")
+		return None
+	if RunCommand(f"sh -c \'if [ -b \"{CONF['root_drive']}\" ]; then exit 0; else exit 1; fi\'", check=False) != 0:
+		PrintError(f"root_drive specified in offline.conf was not a valid block device: {CONF['root_drive']}")
+		return None
+	if not "pin" in CONF:
+		PrintError(f"pin was not specified in offline.conf.")
+		return None
+	if not "password" in CONF:
+		PrintError(f"password was not specified in offline.conf.")
+		return None
+	if not "efi_drive" in CONF or CONF['efi_drive'] == "":
+		CONF['efi_drive'] = CONF['root_drive']
+	if RunCommand(f"sh -c \'if [ -b \"{CONF['efi_drive']}\" ]; then exit 0; else exit 1; fi\'", check=False) != 0:
+		PrintError(f"efi_drive specified in offline.conf was not a valid block device: {CONF['efi_drive']}")
+		return None
+	if not "swap_size" in CONF or CONF['swap_size'] == "":
+		swap_size_set = False
+		for line in ReadFile("/proc/meminfo").splitlines():
+			if line.startswith("MemTotal: "):
+				swap_size_set = True
+				CONF['swap_size'] = f"{int(line.split()[1]) * 1024}"
+				break
+		if not swap_size_set:
+			PrintError(f"Unable to determine MemTotal from /proc/meminfo")
+			return None
+	try:
+		CONF['swap_size'] = int(CONF['swap_size'])
+		if CONF['swap_size'] < -1:
+			raise Exception()
+	except:
+		PrintError(f"swap_size specified in offline.conf was invalid: {CONF['swap_size']}")
+		return None
+	return CONF
+
+# eos_install golden <image.tar.zst>
+# Builds a golden image from the options in ./offline.conf which do not depend on the machine.
+def GoldenMain(args):
+	if len(args) != 1:
+		PrintError("Usage: eos_install golden <image.tar.zst>")
+		return 1
+	if os.geteuid() != 0 or os.getegid() != 0:
+		PrintError(f"Root is required to run eos_install golden. Try sudo eos_install golden.")
+		return 1
+	if os.path.ismount("/new_root"):
+		PrintError("Something is already mounted at /new_root. Please manually unmount.")
+		return 1
+	StartPhase("config parse")
+	CONF = ParseConf(False)
+	if CONF == None:
+		return 1
+	EndPhase("ok")
+
+	# Build inside a bind mount so pacstrap and arch-chroot see /new_root as a mount point
+	RUNTIME = { "golden_image": RealPath(args[0]) }
+	RunCommand(f"rm -rf \"{GOLDEN_BUILD_DIR}\"")
+	RunCommand(f"mkdir -m 755 -p \"{GOLDEN_BUILD_DIR}\"")
+	RunCommand("mkdir -m 755 -p /new_root")
+	RunCommand(f"mount --bind \"{GOLDEN_BUILD_DIR}\" /new_root")
+	try:
+		RunPhases(GoldenPhases(), CONF, RUNTIME)
+	finally:
+		if "chroot" in RUNTIME:
+			RUNTIME.pop("chroot").Close()
+		if os.path.ismount("/new_root"):
+			RunCommand("umount -R /new_root", check=False)
+		print()
+		PrintReport()
+		print()
+
+	print(f"Success! The golden image has been written to {RUNTIME['golden_image']}.")
+	print()
+	return 0
+
+def Main():
+	if len(sys.argv) > 1 and sys.argv[1] == "cache":
+		return CacheMain(sys.argv[2:])
+	if len(sys.argv) > 1 and sys.argv[1] == "golden":
+		return GoldenMain(sys.argv[2:])
+
+	# NOTE outdated gpg keys on the host will cause pacstrap to fail.
+	# Run sudo pacman -Sy archlinux-keyring on host to fix.
+
+	# Initialization and scanity checking
+	StartPhase("sanity checks")
+	ignoreScanityFailures = True
+	if os.geteuid() != 0 or os.getegid() != 0:
+		PrintError(f"Root is required to run eos_install. Try sudo eos_install.")
+		if not ignoreScanityFailures:
+			return 1
+	for dep, pac in DEPENDENCIES:
+		if shutil.which(dep) == None:
+			PrintError(f"Unable to locate required dependency {dep}. Try pacman -Syu {pac}.")
+			if not ignoreScanityFailures:
+				return 1
+	if not os.path.ismount("/sys"):
+		PrintError("Nothing is mounted on /sys. eos_install requires SysFs.")
+		if not ignoreScanityFailures:
+			return 1
+	if not os.path.ismount("/proc"):
+		PrintError("Nothing is mounted on /proc. eos_install requires Proc.")
+		if not ignoreScanityFailures:
+			return 1
+	if not os.path.ismount("/dev"):
+		PrintError("Nothing is mounted on /dev. eos_install requires DevTmpFs.")
+		if not ignoreScanityFailures:
+			return 1
+	cpuinfo = ReadFile("/proc/cpuinfo").replace("\t", "")
+	if not "lm" in cpuinfo[cpuinfo.find("\nflags:") + len("\nflags:"):].splitlines()[0].strip().split(" "):
+		PrintError("EpsilonOS requires an x86-64 CPU.")
+		if not ignoreScanityFailures:
+			return 1
+	if ReadFile("/sys/class/tpm/tpm0/tpm_version_major", defaultContents="").strip() != "2":
+		PrintError("EpsilonOS requires a motherboard with a TPM2 chip.")
+		if not ignoreScanityFailures:
+			return 1
+	if not os.path.exists("/sys/firmware/efi"):
+		PrintError("EpsilonOS requires a UEFI motherboard. Double check that your system is not booted in CSM mode.")
+		if not ignoreScanityFailures:
+			return 1
+	# A target left mounted by a failed install is fine as long as its journal lets us resume it.
+	resumable = os.path.isfile(JOURNAL_PATH)
+	if os.path.ismount("/new_root") and not resumable:
+		PrintError("Something is already mounted at /new_root. Please manually unmount.")
+		if not ignoreScanityFailures:
+			return 1
+	if os.path.isdir("/new_root") and len(os.listdir("/new_root")) != 0 and not resumable:
+		PrintError("/new_root already exists and is not empty. Please manually check.")
+		if not ignoreScanityFailures:
+			return 1
+	if os.path.exists("/dev/mapper/new_cryptroot") and not resumable:
+		PrintError("Something is already open in cryptsetup as new_cryptroot. Please manually close.")
+		if not ignoreScanityFailures:
+			return 1
+	if RunCommand("ping -c 1 1.1.1.1", check=False) != 0:
+		PrintError("An internet connection is required to run eos_install. You may need to setup WiFi with iwctl.")
+		if not ignoreScanityFailures:
+			return 1
+	print()
+	print(f"----- EpsilonOS Installer v{INSTALLER_VERSION} -----")
+	print()
+
+
+
+	# offline.conf template and parsing
+	StartPhase("config parse")
+	CONF = ParseConf(True)
+	if CONF == None:
+		return 1
+	REPORT['drives'] = list(set([ CONF['root_drive'], CONF['efi_drive'] ]))
+	EndPhase("ok")
+
+	# Resume from the journal of an earlier run with the same offline.conf
+	StartPhase("resume")
+	RUNTIME = {}
+	RUNTIME['efi_part'], RUNTIME['root_part'], RUNTIME['root_dev'] = PartitionPaths(CONF)
+	RUNTIME['profiles'] = { drive: ProfileDrive(drive) for drive in [ CONF['root_drive'], CONF['efi_drive'] ] }
+	REPORT['drive_profiles'] = list(RUNTIME['profiles'].values())
+	done = ResumeInstall(CONF, RUNTIME)
+	if len(done) != 0:
+		print(f"Resuming the previous install of {CONF['root_drive']}...")
+	EndPhase("ok")
+
+	# Disk, partition, filesystem, encryption, and package install
+	try:
+		RunPhases(InstallPhases(CONF), CONF, RUNTIME, done)
+	except:
+		if os.path.ismount("/new_root") and os.path.isdir("/new_root/var/log"):
+			WriteReport(REPORT_PATH)
+		raise
+	finally:
+		if "chroot" in RUNTIME:
+			RUNTIME.pop("chroot").Close()
+		# eos_bench collects a copy of the report from the host since the target is unmounted by now
+		if os.environ.get("EOS_INSTALL_REPORT", "") != "":
+			WriteReport(os.environ['EOS_INSTALL_REPORT'])
+		print()
+		PrintReport()
+		print()
+
 	print(f"Success! EpsilonOS has been installed.")
 	print()
 sys.exit(Main())
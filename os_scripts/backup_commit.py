@@ -2,49 +2,129 @@
 import subprocess
 import os
 import sys
-
-# region EOS Script Helpers
-def WriteFile(filePath, contents, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    os.makedirs(os.path.dirname(filePath), exist_ok=True)
-    with open(filePath, "wb" if binary else "w", encoding=(None if binary else "UTF-8")) as file:
-        file.write(contents)
-def ReadFile(filePath, defaultContents=None, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    if not os.path.exists(filePath):
-        if defaultContents != None:
-            return defaultContents
-    with open(filePath, "rb" if binary else "r", encoding=(None if binary else "UTF-8")) as file:
-        return file.read()
-def RunCommand(command, echo=False, capture=False, input=None, check=True, env=None):
-    if echo and capture:
-        raise Exception("Command cannot be run with both echo and capture.")
-    result = subprocess.run(command, stdout=(None if echo else subprocess.PIPE), stderr=(None if echo else subprocess.STDOUT), input=input, env=env, check=False, shell=True, text=True)
-    if check and result.returncode != 0:
-        print(result.stdout)
-        raise Exception(f"Sub-process returned non-zero exit code.\nExitCode: {result.returncode}\nCmdLine: {command}")
-    if capture and not check:
-        return result.stdout.strip(), result.returncode
-    elif capture:
-        return result.stdout.strip()
-    elif not check:
-        return result.returncode
-    else:
-        return
-def PrintWarning(message):
-    print(f"\033[93mWarning: {message}\033[0m")
-def PrintError(message):
-    print(f"\033[91mERROR: {message}\033[0m")
-# endregion
+import time
+import json
+import argparse
+# The shared code is installed to /usr/lib/eos, and in a checkout the copy next to this script is found first.
+sys.path.append("/usr/lib/eos")
+from eos_important_data import *
 
 # Types of .backup files:
+# lastpush.backup: Kept in .git, stores the timestamp when the given repo was last pushed to the remote and the branch tips
+#                  which were pushed, so branches which have not moved since are not pushed again.
 # ignorerepos.backup: Tells this script not to commit, push, or warn about no remote for the git repo in the given folder.
+# audit.backup: Overrides the large file and build output audit for the git repo in the given folder.
+#               Each line is max_file_size=<size such as 200M, or 0 for no limit> or allow_build_output=true.
 # ignorecode.backup: Tells this script to silence warnings about unprotected code in the given folder recursively.
 #
 # To audit .backup files:
-# find /important_data/ -type f -name "*.backup"
+# find /important_data/ -type f -name "*.backup" -not -path "*/.git/lastpush.backup"
+
+def BackupRepo(repo_path, context, messages):
+    before = RepoFingerprint(repo_path, previous=context['repo_state'].get(repo_path))
+    if before != None and context['repo_state'].get(repo_path) == before:
+        return "unchanged"
+    remote = RunCommand(f"git -C \"{repo_path}\" remote", capture=True)
+    if remote == "":
+        messages.append(("error", f"Repo \"{repo_path}\" has a no origin."))
+        return "errored"
+    origin = RunCommand(f"git -C \"{repo_path}\" remote get-url \"{remote}\"", capture=True)
+    if not origin.startswith(f"git@github.com:{context['github_username']}/") or not origin.endswith(".git"):
+        messages.append(("warning", f"Repo \"{repo_path}\" has a bad origin \"{origin}\"."))
+        return "skipped"
+    if not os.path.isfile(os.path.join(repo_path, ".gitignore")):
+        messages.append(("error", f"Repo \"{repo_path}\" has no .gitignore."))
+        return "errored"
+    # A fingerprint which no longer matches the one recorded as clean is stronger evidence than the index not seeing a change,
+    # so git status runs either way. Only a repo with no usable fingerprint is left to the index alone.
+    checked = before != None or repo_path in context['dirty_repos']
+    changes = TimeStep(messages, "status", lambda: GitStatus(repo_path, context['status_options'])) if checked else []
+    deferred = False
+    if len(changes) != 0:
+        flagged = TimeStep(messages, "audit", lambda: AuditChanges(repo_path, changes, LoadAuditSettings(repo_path)))
+        if len(flagged) != 0:
+            # Commits already made are still pushed, only committing the new changes waits until they are fixed.
+            messages += [ ("warning", f"Repo \"{repo_path}\" was not committed because {problem}. Add it to .gitignore or allow it in audit.backup.") for problem in flagged ]
+            deferred = True
+        else:
+            messages.append(("info", f"Committing and pushing changes to \"{repo_path}\"..."))
+            TimeStep(messages, "add", lambda: StageChanges(repo_path, changes))
+            TimeStep(messages, "commit", lambda: RunCommand(f"git -C \"{repo_path}\" commit -m\"Auto-generated backup commit.\""))
+    pushed = PushBranches(repo_path, messages)
+    if deferred:
+        return "deferred"
+    if len(changes) != 0:
+        return "committed"
+    if checked:
+        RecordClean(context['repo_state'], repo_path, before)
+    return "pushed" if pushed else "unchanged"
+
+# Repos are checked for object bloat after every run and the worst few get git maintenance started in the background,
+# so the cost is spread across runs instead of one run repacking everything. The limits match git gc --auto.
+MAINTENANCE_STATE_PATH = "~/.cache/eos_repo_maintenance.json"
+MAINTENANCE_TASKS = [ "loose-objects", "incremental-repack", "commit-graph" ]
+MAINTENANCE_INTERVAL = 86400
+LOOSE_OBJECTS_LIMIT = 6700
+PACKS_LIMIT = 50
+
+# Counts objects straight from .git/objects without starting git. Like git gc --auto the loose objects are estimated
+# from one of the 256 fan out folders since they are spread evenly by hash.
+def CountObjects(repo_path):
+    objects_path = os.path.join(repo_path, ".git", "objects")
+    try:
+        loose = len(os.listdir(os.path.join(objects_path, "17"))) * 256
+    except FileNotFoundError:
+        loose = 0
+    try:
+        packs = len([ file_name for file_name in os.listdir(os.path.join(objects_path, "pack")) if file_name.endswith(".pack") ])
+    except FileNotFoundError:
+        packs = 0
+    has_commit_graph = os.path.exists(os.path.join(objects_path, "info", "commit-graph")) or os.path.isdir(os.path.join(objects_path, "info", "commit-graphs"))
+    return { "loose": loose, "packs": packs, "commit_graph": has_commit_graph }
+
+# Records the object counts of every repo and starts maintenance in up to limit repos which need it the most.
+# Returns the repos it was started in.
+def StartMaintenance(repo_paths, limit):
+    statePath = os.path.realpath(os.path.expanduser(MAINTENANCE_STATE_PATH))
+    try:
+        maintenance_state = json.loads(ReadFile(statePath, defaultContents="{}"))
+    except ValueError:
+        maintenance_state = {}
+    candidates = []
+    for repo_path in repo_paths:
+        counts = CountObjects(repo_path)
+        last_started = maintenance_state.get(repo_path, {}).get("started", 0)
+        maintenance_state[repo_path] = { **counts, "started": last_started }
+        need = max(counts['loose'] / LOOSE_OBJECTS_LIMIT, counts['packs'] / PACKS_LIMIT)
+        if need < 1 and (counts['commit_graph'] or len(ReadBranchTips(repo_path)) == 0):
+            continue
+        # A repo is left alone for a while after maintenance starts since it may still be running.
+        if time.time() - last_started < MAINTENANCE_INTERVAL or os.path.exists(os.path.join(repo_path, ".git", "objects", "maintenance.lock")):
+            continue
+        candidates.append((need, repo_path))
+    started = []
+    for need, repo_path in sorted(candidates, reverse=True)[:limit]:
+        tasks = MAINTENANCE_TASKS if need >= 1 else [ "commit-graph" ]
+        # The new session lets maintenance carry on after this script exits.
+        subprocess.Popen([ "git", "-C", repo_path, "maintenance", "run", "--quiet" ] + [ f"--task={task}" for task in tasks ], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        maintenance_state[repo_path]['started'] = time.time()
+        EmitEvent("maintenance", repo=repo_path, tasks=tasks, loose=maintenance_state[repo_path]['loose'], packs=maintenance_state[repo_path]['packs'])
+        started.append(repo_path)
+    WriteFile(statePath + ".tmp", json.dumps({ repo_path: counts for repo_path, counts in maintenance_state.items() if os.path.isdir(repo_path) }))
+    os.replace(statePath + ".tmp", statePath)
+    return started
 
 def Main():
+    parser = argparse.ArgumentParser(description="Commits and pushes every repo in /important_data.")
+    parser.add_argument("--jobs", type=int, default=8, help="number of repos to work on at once")
+    parser.add_argument("--rescan", action="store_true", help="list every folder instead of trusting the scan cache")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per line instead of text")
+    parser.add_argument("--maintenance", type=int, default=4, help="number of repos to start background git maintenance in (0 to disable)")
+    args = parser.parse_args()
+    if args.json:
+        EnableJsonOutput()
+    startTime = time.monotonic()
+
     # Initial scanity checks
     if os.geteuid() == 0 or os.getegid() == 0:
         script_name = os.path.splitext(os.path.basename(os.path.realpath(__file__)))[0]
@@ -64,7 +144,8 @@ def Main():
         return 1
     sshStatusEndMarker = "! You've successfully authenticated, but GitHub does not provide shell access."
     sshStatusStartMarker = "Hi "
-    sshStatus = RunCommand(f"ssh git@github.com", capture=True, check=False)[0]
+    StartSshMaster("git@github.com")
+    sshStatus = RunCommand(f"{os.environ.get("GIT_SSH_COMMAND", "ssh")} git@github.com", capture=True, check=False)[0]
     sshStatusEndMarkerPos = sshStatus.find(sshStatusEndMarker)
     sshStatusStartMarkerPos = sshStatus.rfind(sshStatusStartMarker, 0, sshStatusEndMarkerPos)
     if sshStatusEndMarkerPos == -1 or sshStatusStartMarkerPos == -1:
@@ -74,33 +155,37 @@ def Main():
 
     # Enumerating files and folders
     print("Locating repos...")
-    repo_paths = [ os.path.dirname(repo_path) for repo_path in RunCommand(f"find \"/important_data/\" -type d -name \".git\"", capture=True).splitlines() ]
+    phaseStartTime = time.monotonic()
+    scan = LoadTree("/important_data", SCAN_CACHE_PATH, args.rescan)
+    ignore_repos_index = PathIndex([ os.path.dirname(backup_file_path) for backup_file_path in scan['backup_file_paths'] if os.path.basename(backup_file_path) == "ignorerepos.backup" ])
+    repo_paths = [ repo_path for repo_path in scan['repo_paths'] if not ignore_repos_index.Contains(repo_path) ]
+    dirty_repos = set(repo_paths if scan['dirty_repos'] == None else scan['dirty_repos'])
+    EmitEvent("phase", name="scan", seconds=round(time.monotonic() - phaseStartTime, 3), source=("scan" if scan['generation'] == None else "index"), repos=len(repo_paths), dirty_repos=len(dirty_repos))
     print()
     
     # Committing and pushing git repos
     print("Committing and pushing all repos...")
-    for i in range(len(repo_paths)):
-        print(f"{i} of {len(repo_paths)}...")
-        repo_path = repo_paths[i]
-        os.chdir(repo_path)
-        remote = RunCommand("git remote", capture=True)
-        if remote == "":
-            PrintError(f"Repo \"{repo_path}\" has a no origin.")
-            continue
-        origin = RunCommand(f"git remote get-url \"{remote}\"", capture=True)
-        if not origin.startswith(f"git@github.com:{githubUsername}/") or not origin.endswith(".git"):
-            PrintWarning(f"Repo \"{repo_path}\" has a bad origin \"{origin}\".")
-            continue
-        if not os.path.isfile(os.path.join(repo_path, ".gitignore")):
-            PrintError(f"Repo \"{repo_path}\" has no .gitignore.")
-            continue
-        changes = RunCommand(f"git status --porcelain", capture=True)
-        if changes != "":
-            print(f"Committing and pushing changes to \"{repo_path}\"...")
-            RunCommand(f"git rm --cached -r .", check=False) # Ignore status as this fails when nothing is tracked currently
-            RunCommand(f"git add --all")
-            RunCommand(f"git commit -m\"Auto-generated backup commit.\"")
-        RunCommand(f"git push origin --all")
+    phaseStartTime = time.monotonic()
+    context = { "github_username": githubUsername, "dirty_repos": dirty_repos, "repo_state": LoadRepoState(), "status_options": GitStatusOptions() }
+    outcomes, timings = ProcessRepos(repo_paths, lambda repo_path, messages: BackupRepo(repo_path, context, messages), args.jobs)
+    MarkClean(scan, outcomes['committed'] + outcomes['pushed'] + outcomes['unchanged'])
+    SaveRepoState(context['repo_state'])
+    EmitEvent("phase", name="repos", seconds=round(time.monotonic() - phaseStartTime, 3))
+    print()
+
+    # Starting git maintenance in the repos which need it
+    if args.maintenance > 0:
+        phaseStartTime = time.monotonic()
+        started = StartMaintenance([ repo_path for repo_path in repo_paths if not repo_path in outcomes['errored'] ], args.maintenance)
+        EmitEvent("phase", name="maintenance", seconds=round(time.monotonic() - phaseStartTime, 3), started=len(started))
+        for repo_path in started:
+            print(f"Started git maintenance in \"{repo_path}\".")
+        if len(started) != 0:
+            print()
+    PrintRepoSummary(outcomes)
+    print()
+    PrintSlowestRepos(timings)
+    EmitEvent("summary", seconds=round(time.monotonic() - startTime, 3), **{ outcome: len(outcomes[outcome]) for outcome in REPO_OUTCOMES })
 
     print("Backup Complete!")
     return 0
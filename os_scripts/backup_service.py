@@ -2,6 +2,10 @@
 import subprocess
 import os
 import sys
+import time
+import json
+import argparse
+import threading
 
 # region EOS Script Helpers
 def WriteFile(filePath, contents, binary=False):
@@ -37,7 +41,64 @@ def PrintError(message):
     print(f"\033[91mERROR: {message}\033[0m")
 # endregion
 
+# region EOS Script Events
+# With --json every line the script prints becomes one JSON object with a level, and metrics such as phase timings
+# are emitted as events of their own, so runs can be collected and graphed. The human readable output stays the default.
+class JsonLinesOutput:
+    LEVELS = [ ("\033[93mWarning: ", "warning"), ("\033[91mERROR: ", "error") ]
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = ""
+        self.lock = threading.Lock()
+    def write(self, text):
+        with self.lock:
+            self.pending += text
+            while "\n" in self.pending:
+                line, self.pending = self.pending.split("\n", 1)
+                if line.strip() == "":
+                    continue
+                level = "info"
+                for prefix, prefixLevel in JsonLinesOutput.LEVELS:
+                    if line.startswith(prefix):
+                        line = line[len(prefix):].removesuffix("\033[0m")
+                        level = prefixLevel
+                self.Emit({ "event": "message", "level": level, "message": line })
+        return len(text)
+    def flush(self):
+        self.stream.flush()
+    def Emit(self, fields):
+        self.stream.write(json.dumps({ "time": round(time.time(), 3), **fields }) + "\n")
+        self.stream.flush()
+def EnableJsonOutput():
+    sys.stdout = JsonLinesOutput(sys.stdout)
+def JsonOutputEnabled():
+    return isinstance(sys.stdout, JsonLinesOutput)
+def EmitEvent(event, **fields):
+    if JsonOutputEnabled():
+        with sys.stdout.lock:
+            sys.stdout.Emit({ "event": event, **fields })
+# endregion
+
+# Turns the output of rsync --stats into fields such as total_file_size and total_bytes_sent.
+def ParseRsyncStats(output):
+    stats = {}
+    for line in output.splitlines():
+        if not ":" in line:
+            continue
+        key, value = line.split(":", 1)
+        value = value.strip().split(" ")[0].replace(",", "")
+        if value.isdigit():
+            stats[key.strip().lower().replace(" ", "_")] = int(value)
+    return stats
+
 def Main():
+    parser = argparse.ArgumentParser(description="Copies /important_data to the backup drive with rsync.")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per line instead of text")
+    args = parser.parse_args()
+    if args.json:
+        EnableJsonOutput()
+    startTime = time.monotonic()
+
     if os.geteuid() != 0 or os.getegid() != 0:
         script_name = os.path.splitext(os.path.basename(os.path.realpath(__file__)))[0]
         PrintError(f"Root is required to take a backup. Try sudo {script_name}.")
@@ -63,9 +124,18 @@ def Main():
         return 1
     RunCommand(f"mount -t ext4 -o rw,noatime,discard,errors=remount-ro \"{backup_dev}\" /backup")
     RunCommand(f"mount -o ro,noatime,discard,errors=remount-ro,remount /important_data")
-    RunCommand(f"rsync --verbose --archive --executability --acls --xattrs --atimes --open-noatime --delete-after --numeric-ids --human-readable --progress --sparse --hard-links /important_data/ /backup/", echo=True)
+    rsyncStartTime = time.monotonic()
+    if JsonOutputEnabled():
+        # The per file output of rsync would break the JSON lines so only its totals are reported.
+        output = RunCommand(f"rsync --stats --archive --executability --acls --xattrs --atimes --open-noatime --delete-after --numeric-ids --sparse --hard-links /important_data/ /backup/", capture=True)
+        stats = ParseRsyncStats(output)
+        seconds = time.monotonic() - rsyncStartTime
+        EmitEvent("rsync", seconds=round(seconds, 3), bytes_per_second=round(stats.get("total_bytes_sent", 0) / max(seconds, 0.001)), **stats)
+    else:
+        RunCommand(f"rsync --verbose --archive --executability --acls --xattrs --atimes --open-noatime --delete-after --numeric-ids --human-readable --progress --sparse --hard-links /important_data/ /backup/", echo=True)
     RunCommand(f"mount -o rw,noatime,discard,errors=remount-ro,remount /important_data")
     RunCommand(f"umount /backup")
+    EmitEvent("summary", seconds=round(time.monotonic() - startTime, 3))
     print("Backup Complete!")
     return 0
 sys.exit(Main())
\ No newline at end of file
@@ -0,0 +1,633 @@
+import subprocess
+import os
+import sys
+import time
+import json
+import hashlib
+import socket
+import shutil
+import tempfile
+import atexit
+import threading
+import concurrent.futures
+
+# Everything important_data_scan, backup_commit and important_data_index share, including the EOS Script Helpers.
+# Each of them imports all of it with from eos_important_data import *. install.sh installs it to /usr/lib/eos,
+# which the scripts add to sys.path after their own folder so a checkout uses its own copy.
+
+# region EOS Script Helpers
+def WriteFile(filePath, contents, binary=False):
+    filePath = os.path.realpath(os.path.expanduser(filePath))
+    os.makedirs(os.path.dirname(filePath), exist_ok=True)
+    with open(filePath, "wb" if binary else "w", encoding=(None if binary else "UTF-8")) as file:
+        file.write(contents)
+def ReadFile(filePath, defaultContents=None, binary=False):
+    filePath = os.path.realpath(os.path.expanduser(filePath))
+    if not os.path.exists(filePath):
+        if defaultContents != None:
+            return defaultContents
+    with open(filePath, "rb" if binary else "r", encoding=(None if binary else "UTF-8")) as file:
+        return file.read()
+def RunCommand(command, echo=False, capture=False, input=None, check=True, env=None):
+    if echo and capture:
+        raise Exception("Command cannot be run with both echo and capture.")
+    result = subprocess.run(command, stdout=(None if echo else subprocess.PIPE), stderr=(None if echo else subprocess.STDOUT), input=input, env=env, check=False, shell=True, text=True)
+    if check and result.returncode != 0:
+        raise Exception(f"Sub-process returned non-zero exit code.\nExitCode: {result.returncode}\nCmdLine: {command}\n\n{result.stdout}")
+    if capture and not check:
+        return result.stdout.strip(), result.returncode
+    elif capture:
+        return result.stdout.strip()
+    elif not check:
+        return result.returncode
+    else:
+        return
+def PrintWarning(message):
+    print(f"\033[93mWarning: {message}\033[0m")
+def PrintError(message):
+    print(f"\033[91mERROR: {message}\033[0m")
+# endregion
+
+# region EOS Script Events
+# With --json every line the script prints becomes one JSON object with a level, and metrics such as phase timings
+# are emitted as events of their own, so runs can be collected and graphed. The human readable output stays the default.
+class JsonLinesOutput:
+    LEVELS = [ ("\033[93mWarning: ", "warning"), ("\033[91mERROR: ", "error") ]
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = ""
+        self.lock = threading.Lock()
+    def write(self, text):
+        with self.lock:
+            self.pending += text
+            while "\n" in self.pending:
+                line, self.pending = self.pending.split("\n", 1)
+                if line.strip() == "":
+                    continue
+                level = "info"
+                for prefix, prefixLevel in JsonLinesOutput.LEVELS:
+                    if line.startswith(prefix):
+                        line = line[len(prefix):].removesuffix("\033[0m")
+                        level = prefixLevel
+                self.Emit({ "event": "message", "level": level, "message": line })
+        return len(text)
+    def flush(self):
+        self.stream.flush()
+    def Emit(self, fields):
+        self.stream.write(json.dumps({ "time": round(time.time(), 3), **fields }) + "\n")
+        self.stream.flush()
+def EnableJsonOutput():
+    sys.stdout = JsonLinesOutput(sys.stdout)
+def JsonOutputEnabled():
+    return isinstance(sys.stdout, JsonLinesOutput)
+def EmitEvent(event, **fields):
+    if JsonOutputEnabled():
+        with sys.stdout.lock:
+            sys.stdout.Emit({ "event": event, **fields })
+# endregion
+
+CODE_EXTS = [
+    ".c", ".cpp", ".cc", ".asm", ".cs", ".java", # C family
+    ".py", ".ps1", ".sh", ".cmd", ".bat", # Scripting
+    ".js", ".ts", ".html", ".css", ".htm", # Web
+    ".rb", ".swift", ".go", ".php", ".r", ".rs", ".sql", ".kt", ".dart" # Other
+]
+
+# Scan results are cached here between runs of important_data_scan and backup_commit.
+SCAN_CACHE_PATH = "~/.cache/eos_important_data_scan.json"
+SCAN_CACHE_VERSION = 2
+
+# Lists one folder and classifies its entries by name and type. Both only change when the mtime of the folder does.
+def ScanDir(dir_path):
+    with os.scandir(dir_path) as iterator:
+        entries = list(iterator)
+    listing = { "subdirs": [], "code": [], "backups": [], "repo": False, "ignorecode": False }
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name == ".git":
+                listing['repo'] = True
+            else:
+                listing['subdirs'].append(entry.name)
+        elif entry.is_file(follow_symlinks=False):
+            if entry.name.endswith(".backup"):
+                listing['backups'].append(entry.name)
+                listing['ignorecode'] = listing['ignorecode'] or entry.name == "ignorecode.backup"
+            elif entry.name.endswith(tuple(CODE_EXTS)):
+                listing['code'].append(entry.name)
+    return listing
+
+# Folders at or under an ignorecode.backup are hidden, so their code files are not reported.
+# Their repos and .backup files still are, since only ignorerepos.backup keeps a repo from being backed up.
+# Returns whether a folder is hidden from its listing and whether its parent is.
+def ScanContext(listing, hidden):
+    return hidden or listing['ignorecode']
+
+# Adds what a folder reports to the lists of a scan given its hidden flag from ScanContext.
+def ReportListing(dir_path, listing, hidden, code_paths, repo_paths, backup_file_paths):
+    if listing['repo']:
+        repo_paths.append(dir_path)
+    if not hidden:
+        code_paths += [ os.path.join(dir_path, name) for name in listing['code'] ]
+    backup_file_paths += [ os.path.join(dir_path, name) for name in listing['backups'] ]
+
+# Walks the tree once and returns the code files, repo roots and .backup files in it.
+# .git folders are never entered, so the cost of a scan is the size of the tree we care about rather than the size of every object store.
+#
+# Like the untracked cache in git, the listing of every folder is saved to cachePath along with its inode and mtime.
+# Later scans only list folders whose mtime changed, so an unchanged folder costs one stat no matter how many files it has.
+def ScanTree(rootPath, cachePath=None, rescan=False):
+    cache = {}
+    if cachePath != None and not rescan:
+        try:
+            saved = json.loads(ReadFile(cachePath, defaultContents="null"))
+            if saved != None and saved['version'] == SCAN_CACHE_VERSION and saved['root'] == rootPath:
+                cache = saved['dirs']
+        except ValueError:
+            PrintWarning(f"Ignoring corrupt scan cache \"{cachePath}\".")
+    # A folder modified this recently could change again without its mtime moving, so its listing is not trusted next run.
+    racyTime = time.time_ns() - 2000000000
+    code_paths = []
+    repo_paths = []
+    backup_file_paths = []
+    dirs = {}
+    pending = [ (rootPath, False) ]
+    while len(pending) != 0:
+        dir_path, hidden = pending.pop()
+        try:
+            stat = os.stat(dir_path)
+            listing = cache.get(dir_path)
+            if listing == None or listing['stamp'] != [ stat.st_ino, stat.st_mtime_ns ]:
+                listing = ScanDir(dir_path)
+                listing['stamp'] = [ stat.st_ino, stat.st_mtime_ns ] if stat.st_mtime_ns < racyTime else None
+        except OSError as error:
+            PrintWarning(f"Unable to scan \"{dir_path}\". {error.strerror}.")
+            continue
+        dirs[dir_path] = listing
+        hidden = ScanContext(listing, hidden)
+        ReportListing(dir_path, listing, hidden, code_paths, repo_paths, backup_file_paths)
+        pending += [ (os.path.join(dir_path, name), hidden) for name in listing['subdirs'] ]
+    if cachePath != None:
+        cachePath = os.path.realpath(os.path.expanduser(cachePath))
+        WriteFile(cachePath + ".tmp", json.dumps({ "version": SCAN_CACHE_VERSION, "root": rootPath, "dirs": dirs }))
+        os.replace(cachePath + ".tmp", cachePath)
+    return sorted(code_paths), sorted(repo_paths), sorted(backup_file_paths)
+
+# important_data_index keeps the scan in memory, kept up to date with inotify, and answers queries on this socket.
+INDEX_SOCKET_PATH = os.path.join(os.environ.get("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}"), "important_data_index.sock")
+
+# Sends one request to important_data_index and returns its reply, or None if it is not running or cannot answer.
+def QueryIndex(request, timeout=5):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(INDEX_SOCKET_PATH)
+            client.sendall((json.dumps(request) + "\n").encode("UTF-8"))
+            reply = b""
+            while not reply.endswith(b"\n"):
+                chunk = client.recv(1048576)
+                if len(chunk) == 0:
+                    break
+                reply += chunk
+        reply = json.loads(reply)
+    except (OSError, ValueError):
+        return None
+    if "error" in reply:
+        PrintWarning(f"important_data_index could not answer so a full scan will be done. {reply['error']}")
+        return None
+    return reply
+
+# Asks important_data_index for the scan of rootPath and falls back to ScanTree when it is not running.
+# dirty_repos lists the repos with changes since they were last marked clean, or is None after a full scan.
+def LoadTree(rootPath, cachePath, rescan):
+    if not rescan:
+        reply = QueryIndex({ "command": "scan", "root": rootPath })
+        if reply != None:
+            return reply
+    code_paths, repo_paths, backup_file_paths = ScanTree(rootPath, cachePath, rescan)
+    return { "code_paths": code_paths, "repo_paths": repo_paths, "backup_file_paths": backup_file_paths, "dirty_repos": None, "generation": None }
+
+# Tells important_data_index that these repos were found clean, unless they changed again after the scan was taken.
+def MarkClean(scan, repo_paths):
+    if scan['generation'] != None and len(repo_paths) != 0:
+        QueryIndex({ "command": "clean", "repos": repo_paths, "generation": scan['generation'] })
+
+# Answers which of a set of folders contains a path in time proportional to the depth of the path.
+# Paths are compared a component at a time so /a/foo2 is not mistaken for being inside /a/foo.
+class PathIndex:
+    def __init__(self, folderPaths=None):
+        self.root = {}
+        if folderPaths == None:
+            folderPaths = []
+        for folderPath in folderPaths:
+            self.Add(folderPath)
+    def Add(self, folderPath):
+        node = self.root
+        for component in os.path.normpath(folderPath).split(os.sep):
+            node = node.setdefault(component, {})
+        node[None] = folderPath
+    # Returns the deepest indexed folder which is or contains path, or None if there is not one.
+    def Find(self, path):
+        node = self.root
+        found = None
+        for component in os.path.normpath(path).split(os.sep):
+            node = node.get(component)
+            if node == None:
+                break
+            found = node.get(None, found)
+        return found
+    def Contains(self, path):
+        return self.Find(path) != None
+
+REPO_OUTCOMES = [ "committed", "pushed", "unchanged", "deferred", "skipped", "errored" ]
+
+# While repos are processed progress is reported every PROGRESS_INTERVAL seconds. The rate is smoothed exponentially
+# so the ETA follows the recent pace of the run, since runs of fast unchanged repos and slow pushes tend to come in bursts.
+PROGRESS_INTERVAL = 2
+PROGRESS_SMOOTHING = 0.3
+SLOWEST_REPOS_COUNT = 5
+
+class RepoProgress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.startTimes = {}
+        self.lock = threading.Lock()
+        self.lastTime = time.monotonic()
+        self.lastDone = 0
+        self.rate = None
+    def Started(self, repo_path):
+        with self.lock:
+            self.startTimes[repo_path] = time.monotonic()
+    def Finished(self):
+        with self.lock:
+            self.done += 1
+    # Called by the thread printing results while it waits on waiting_path. A repo holding up the output for longer
+    # than PROGRESS_INTERVAL is named so slow repos can be spotted while the run is still going.
+    def Report(self, waiting_path):
+        now = time.monotonic()
+        if now - self.lastTime < PROGRESS_INTERVAL:
+            return
+        with self.lock:
+            done = self.done
+            waitingTime = now - self.startTimes.get(waiting_path, now)
+        rate = (done - self.lastDone) / (now - self.lastTime)
+        self.rate = rate if self.rate == None else PROGRESS_SMOOTHING * rate + (1 - PROGRESS_SMOOTHING) * self.rate
+        self.lastTime = now
+        self.lastDone = done
+        eta = (self.total - done) / self.rate if self.rate > 0 else None
+        if JsonOutputEnabled():
+            EmitEvent("progress", done=done, total=self.total, rate=round(self.rate, 3), eta=(None if eta == None else round(eta, 1)), waiting_on=waiting_path, waiting_seconds=round(waitingTime, 3))
+        else:
+            etaText = "ETA unknown" if eta == None else f"about {int(eta // 60)}m{int(eta % 60):02}s left"
+            waitingText = f" Waiting on \"{waiting_path}\" for {waitingTime:.0f}s..." if waitingTime >= PROGRESS_INTERVAL else ""
+            print(f"{done} of {self.total} repos done, {self.rate:.1f} repos/s, {etaText}.{waitingText}")
+
+# Runs func() and records how long it took as a step of the repo, which ProcessRepos adds to that repo's timings.
+def TimeStep(messages, step, func):
+    stepStartTime = time.monotonic()
+    try:
+        return func()
+    finally:
+        messages.append(("step", (step, time.monotonic() - stepStartTime)))
+
+# Runs func(repo_path, messages) for every repo on a pool of jobs threads. func returns one of REPO_OUTCOMES and
+# appends (level, text) tuples to messages instead of printing, so the output of each repo is printed together and in order.
+# A level of "event" takes a dict of fields instead of text which is passed to EmitEvent, and "step" takes a
+# (step, seconds) tuple from TimeStep. Returns the repos by outcome and the timings of every repo.
+def ProcessRepos(repo_paths, func, jobs):
+    progress = RepoProgress(len(repo_paths))
+    def Process(repo_path):
+        messages = []
+        progress.Started(repo_path)
+        startTime = time.monotonic()
+        try:
+            outcome = func(repo_path, messages)
+        except Exception as exception:
+            messages.append(("error", f"Repo \"{repo_path}\" failed. {exception}"))
+            outcome = "errored"
+        progress.Finished()
+        return outcome, messages, time.monotonic() - startTime
+    outcomes = { outcome: [] for outcome in REPO_OUTCOMES }
+    timings = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [ executor.submit(Process, repo_path) for repo_path in repo_paths ]
+        for repo_path, future in zip(repo_paths, futures):
+            progress.Report(repo_path)
+            while True:
+                try:
+                    outcome, messages, seconds = future.result(timeout=PROGRESS_INTERVAL)
+                    break
+                except concurrent.futures.TimeoutError:
+                    progress.Report(repo_path)
+            steps = {}
+            for level, text in messages:
+                if level == "event":
+                    EmitEvent(**text)
+                elif level == "step":
+                    steps[text[0]] = steps.get(text[0], 0) + text[1]
+                elif level == "error":
+                    PrintError(text)
+                elif level == "warning":
+                    PrintWarning(text)
+                else:
+                    print(text)
+            EmitEvent("repo", repo=repo_path, outcome=outcome, seconds=round(seconds, 3), steps={ step: round(stepTime, 3) for step, stepTime in steps.items() })
+            outcomes[outcome].append(repo_path)
+            timings.append({ "repo": repo_path, "seconds": seconds, "steps": steps })
+    return outcomes, timings
+
+def PrintRepoSummary(outcomes):
+    print(", ".join([ f"{len(outcomes[outcome])} {outcome}" for outcome in REPO_OUTCOMES ]))
+    for outcome in [ "committed", "pushed", "deferred", "skipped", "errored" ]:
+        for repo_path in outcomes[outcome]:
+            print(f"{outcome:>9} {repo_path}")
+
+# Lists the repos which took the longest and how long each spent in every step. Repos which never reached a timed step,
+# such as ones skipped by their fingerprint, are left out.
+def PrintSlowestRepos(timings):
+    slowest = sorted([ timing for timing in timings if len(timing['steps']) != 0 ], key=lambda timing: -timing['seconds'])[:SLOWEST_REPOS_COUNT]
+    if len(slowest) == 0:
+        return
+    print("Slowest repos:")
+    for timing in slowest:
+        print(f"{timing['seconds']:>8.2f}s {timing['repo']} ({", ".join([ f"{step} {stepTime:.2f}s" for step, stepTime in timing['steps'].items() ])})")
+    print()
+
+# Repos found clean and in sync are fingerprinted here so later runs can skip them without starting git.
+REPO_STATE_PATH = "~/.cache/eos_repo_state.json"
+
+def StatKey(path):
+    try:
+        stat = os.lstat(path)
+    except FileNotFoundError:
+        return None
+    return [ stat.st_ino, stat.st_size, stat.st_mtime_ns ]
+
+def ReadRefs(git_dir):
+    refs = {}
+    for dir_path, _, file_names in os.walk(os.path.join(git_dir, "refs")):
+        for file_name in file_names:
+            ref_path = os.path.join(dir_path, file_name)
+            refs[os.path.relpath(ref_path, git_dir)] = ReadFile(ref_path).strip()
+    return refs
+
+# Top level folders which git ignores as a whole, such as build output and node_modules, are left out of the working tree
+# part of a fingerprint since git status does not look inside them either. Finding them takes one git check-ignore,
+# so the result is kept in the fingerprint and reused for as long as the files which decide it have not changed.
+# Changes to the global core.excludesFile are not noticed until one of these does.
+def IgnoreKey(repo_path):
+    return [ StatKey(os.path.join(repo_path, ".gitignore")), StatKey(os.path.join(repo_path, ".git", "info", "exclude")), StatKey(os.path.join(repo_path, ".git", "index")) ]
+
+# check-ignore leaves out folders which contain tracked files, so only folders git skips entirely are returned.
+def IgnoredDirs(repo_path, previous=None):
+    key = IgnoreKey(repo_path)
+    if previous != None and previous.get("ignored", {}).get("key") == key:
+        return previous['ignored']
+    names = []
+    with os.scandir(repo_path) as iterator:
+        for entry in iterator:
+            if entry.name != ".git" and entry.is_dir(follow_symlinks=False) and not os.path.exists(os.path.join(entry.path, ".git")):
+                names.append(entry.name)
+    dirs = []
+    if len(names) != 0:
+        output, _ = RunCommand(f"git -C \"{repo_path}\" check-ignore -z --stdin", capture=True, input="\0".join(names), check=False)
+        dirs = sorted([ name for name in output.split("\0") if name in names ])
+    return { "key": key, "dirs": dirs }
+
+# Returns a fingerprint of everything git status and git push look at: HEAD, every ref, packed-refs, the config, the index,
+# and the stat data of the working tree, read straight from disk without starting git. Returns None when it cannot be trusted,
+# such as when a file changed too recently for its mtime to tell it apart from the next change.
+# Walking the working tree stats every entry outside of ignored top level folders, so it costs about as much as git status
+# with a cold untracked cache, but it avoids starting git at all for the repos which turn out to be unchanged.
+# Pass previous, the last fingerprint recorded for the repo, to reuse its ignored folders, and worktree to reuse the
+# working tree part of an earlier fingerprint.
+def RepoFingerprint(repo_path, worktree=None, previous=None):
+    git_dir = os.path.join(repo_path, ".git")
+    if not os.path.isdir(git_dir):
+        return None
+    try:
+        if worktree == None:
+            ignored = IgnoredDirs(repo_path, previous)
+            racyTime = time.time_ns() - 2000000000
+            digest = hashlib.sha256()
+            pending = [ repo_path ]
+            while len(pending) != 0:
+                dir_path = pending.pop()
+                with os.scandir(dir_path) as iterator:
+                    entries = sorted(iterator, key=lambda entry: entry.name)
+                for entry in entries:
+                    if entry.name == ".git" or (dir_path == repo_path and entry.name in ignored['dirs']):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                    if max(stat.st_mtime_ns, stat.st_ctime_ns) >= racyTime:
+                        return None
+                    digest.update(f"{entry.path}\0{stat.st_mode}\0{stat.st_ino}\0{stat.st_size}\0{stat.st_mtime_ns}\0{stat.st_ctime_ns}\n".encode("UTF-8", "surrogateescape"))
+                    # Nested repos are checked on their own.
+                    if entry.is_dir(follow_symlinks=False) and not os.path.exists(os.path.join(entry.path, ".git")):
+                        pending.append(entry.path)
+            worktree = digest.hexdigest()
+        else:
+            # git may have rewritten the index since, but the folders it ignores are the same as when the working tree was walked.
+            ignored = { "key": IgnoreKey(repo_path), "dirs": previous['ignored']['dirs'] }
+        return {
+            "head": ReadFile(os.path.join(git_dir, "HEAD")).strip(),
+            "refs": ReadRefs(git_dir),
+            "packed_refs": StatKey(os.path.join(git_dir, "packed-refs")),
+            "config": StatKey(os.path.join(git_dir, "config")),
+            "index": StatKey(os.path.join(git_dir, "index")),
+            "worktree": worktree,
+            "ignored": ignored,
+        }
+    except OSError:
+        return None
+
+# Records a repo as clean using the working tree fingerprint taken before git looked at it and the git metadata as git left it.
+# Nothing is recorded if a branch moved in the meantime since that commit may not have been pushed.
+# Only call it after git status found no changes, otherwise a change git never looked at would be trusted from then on.
+def RecordClean(repo_state, repo_path, before):
+    if before == None:
+        return
+    after = RepoFingerprint(repo_path, before['worktree'], before)
+    if after == None or after['head'] != before['head']:
+        return
+    if { ref: tip for ref, tip in after['refs'].items() if ref.startswith("refs/heads/") } != { ref: tip for ref, tip in before['refs'].items() if ref.startswith("refs/heads/") }:
+        return
+    repo_state[repo_path] = after
+
+def LoadRepoState():
+    try:
+        return json.loads(ReadFile(REPO_STATE_PATH, defaultContents="{}"))
+    except ValueError:
+        PrintWarning(f"Ignoring corrupt repo state \"{REPO_STATE_PATH}\".")
+        return {}
+
+def SaveRepoState(repo_state):
+    statePath = os.path.realpath(os.path.expanduser(REPO_STATE_PATH))
+    WriteFile(statePath + ".tmp", json.dumps(repo_state))
+    os.replace(statePath + ".tmp", statePath)
+
+# Each repo remembers what it last pushed in .git/lastpush.backup, so branches which have not moved since are not
+# pushed again and a repo where no branch moved is skipped without contacting the remote at all.
+LASTPUSH_FILE_NAME = "lastpush.backup"
+
+# Reads the tip of every local branch straight from disk. Loose refs take precedence over packed-refs like they do in git.
+def ReadBranchTips(repo_path):
+    git_dir = os.path.join(repo_path, ".git")
+    tips = {}
+    for line in ReadFile(os.path.join(git_dir, "packed-refs"), defaultContents="").splitlines():
+        if line.startswith("#") or line.startswith("^"):
+            continue
+        tip, _, ref = line.partition(" ")
+        if ref.startswith("refs/heads/"):
+            tips[ref] = tip
+    tips.update({ ref: tip for ref, tip in ReadRefs(git_dir).items() if ref.startswith("refs/heads/") and not tip.startswith("ref:") })
+    return tips
+
+def LoadLastPush(repo_path):
+    try:
+        last_push = json.loads(ReadFile(os.path.join(repo_path, ".git", LASTPUSH_FILE_NAME), defaultContents="null"))
+    except ValueError:
+        return None
+    return last_push if isinstance(last_push, dict) and isinstance(last_push.get("refs"), dict) else None
+
+# Pushes the branches which moved since the last push and returns whether anything was pushed.
+def PushBranches(repo_path, messages):
+    tips = ReadBranchTips(repo_path)
+    last_push = LoadLastPush(repo_path)
+    moved = [ ref for ref, tip in sorted(tips.items()) if last_push == None or last_push['refs'].get(ref) != tip ]
+    if len(moved) == 0:
+        return False
+    pushStartTime = time.monotonic()
+    TimeStep(messages, "push", lambda: RunCommand(f"git -C \"{repo_path}\" push origin {" ".join([ f"\"{ref}\"" for ref in moved ])}"))
+    messages.append(("event", { "event": "push", "repo": repo_path, "refs": len(moved), "seconds": round(time.monotonic() - pushStartTime, 3) }))
+    # The tips read before pushing are recorded, so a branch which moved during the push is pushed again next time.
+    WriteFile(os.path.join(repo_path, ".git", LASTPUSH_FILE_NAME), json.dumps({ "timestamp": time.time(), "refs": tips }) + "\n")
+    return True
+
+# Options for git status which let it skip work: the untracked cache, and the builtin fsmonitor when git was built with it.
+def GitStatusOptions():
+    options = "-c core.untrackedCache=true"
+    if "feature: fsmonitor--daemon" in RunCommand("git version --build-options", capture=True):
+        options += " -c core.fsmonitor=true"
+    return options
+
+# Changes are audited before they are committed so one stray video or build artifact cannot bloat a repo for good.
+# An audit.backup in the repo can override the defaults with max_file_size=<size> (0 for no limit) and allow_build_output=true.
+DEFAULT_MAX_FILE_SIZE = 50 * 1048576
+BUILD_OUTPUT_EXTS = [ ".o", ".obj", ".a", ".lib", ".so", ".dll", ".exe", ".pdb", ".class", ".jar", ".pyc", ".iso", ".img" ]
+EXECUTABLE_MAGIC = [ b"\x7fELF", b"MZ" ]
+
+def ParseSize(text):
+    units = { "K": 1024, "M": 1048576, "G": 1073741824 }
+    text = text.strip().upper().removesuffix("B").removesuffix("I")
+    if len(text) != 0 and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def FormatSize(byteCount):
+    for unit in [ "B", "KiB", "MiB", "GiB" ]:
+        if byteCount < 1024 or unit == "GiB":
+            return f"{byteCount:.0f} {unit}" if unit == "B" else f"{byteCount:.1f} {unit}"
+        byteCount /= 1024
+
+# Returns the audit settings of a repo from its audit.backup. Raises ValueError if the marker is invalid.
+def LoadAuditSettings(repo_path):
+    settings = { "max_file_size": DEFAULT_MAX_FILE_SIZE, "allow_build_output": False }
+    for line in ReadFile(os.path.join(repo_path, "audit.backup"), defaultContents="").splitlines():
+        if line.strip() == "" or line.startswith("#"):
+            continue
+        key, _, value = line.partition("=")
+        if key.strip() == "max_file_size":
+            settings['max_file_size'] = ParseSize(value)
+        elif key.strip() == "allow_build_output":
+            settings['allow_build_output'] = value.strip().lower() == "true"
+        else:
+            raise ValueError(f"Unknown setting {key.strip()} in audit.backup.")
+    return settings
+
+# Returns why a file should not be committed, or None if it is fine.
+def AuditFile(filePath, settings):
+    try:
+        stat = os.lstat(filePath)
+    except FileNotFoundError:
+        return None
+    if not os.path.isfile(filePath) or os.path.islink(filePath):
+        return None
+    if settings['max_file_size'] != 0 and stat.st_size > settings['max_file_size']:
+        return f"is {FormatSize(stat.st_size)} which is over the {FormatSize(settings['max_file_size'])} limit"
+    if settings['allow_build_output']:
+        return None
+    if filePath.lower().endswith(tuple(BUILD_OUTPUT_EXTS)):
+        return "looks like build output"
+    with open(filePath, "rb") as file:
+        if file.read(4).startswith(tuple(EXECUTABLE_MAGIC)):
+            return "is a compiled executable"
+    return None
+
+# Streams git status and returns a (status, path) tuple for every changed path.
+def GitStatus(repo_path, status_options=""):
+    changes = []
+    process = subprocess.Popen(f"git -C \"{repo_path}\" {status_options} status --porcelain=v1 -z --untracked-files=all", stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, shell=True)
+    pending = b""
+    skipSource = False
+    for chunk in iter(lambda: process.stdout.read(65536), b""):
+        records = (pending + chunk).split(b"\0")
+        pending = records.pop()
+        for record in records:
+            # Renames and copies are followed by the path they came from.
+            if skipSource:
+                skipSource = False
+                continue
+            status = record[:2].decode("UTF-8")
+            skipSource = "R" in status or "C" in status
+            changes.append((status, os.fsdecode(record[3:])))
+    if process.wait() != 0:
+        raise Exception(f"git status exited with {process.returncode} in \"{repo_path}\".")
+    return changes
+
+# Returns a description of each new or modified path from GitStatus which fails the audit.
+def AuditChanges(repo_path, changes, settings):
+    flagged = []
+    for status, path in changes:
+        if "D" in status:
+            continue
+        problem = AuditFile(os.path.join(repo_path, path), settings)
+        if problem != None:
+            flagged.append(f"\"{path}\" {problem}")
+    return flagged
+
+# Stages the changes from GitStatus without rebuilding the index. Keeping the index keeps its stat cache, so git
+# only reads and hashes the files which changed rather than every file in the repo.
+# Tracked files which .gitignore now covers are untracked, then every path changed in the working tree is added.
+# Changes which are only in the index, such as a rename done with git mv, are already staged.
+def StageChanges(repo_path, changes):
+    ignored = [ path for path in RunCommand(f"git -C \"{repo_path}\" ls-files -z --cached --ignored --exclude-standard", capture=True).split("\0") if path != "" ]
+    if len(ignored) != 0:
+        RunCommand(f"git --literal-pathspecs -C \"{repo_path}\" rm --cached --quiet --pathspec-from-file=- --pathspec-file-nul", input="\0".join(ignored))
+    ignored = set(ignored)
+    paths = [ path for status, path in changes if status[1] != " " and not path in ignored ]
+    if len(paths) != 0:
+        RunCommand(f"git --literal-pathspecs -C \"{repo_path}\" add --all --pathspec-from-file=- --pathspec-file-nul", input="\0".join(paths))
+
+# A single ssh master connection is shared by the startup probe and every push so each push skips the handshake and
+# key exchange. Git picks it up through GIT_SSH_COMMAND, and ControlMaster=no makes each ssh connect on its own
+# instead if the master has gone away. The default --jobs stays under the MaxSessions limit of 10 on a connection.
+# The master is closed at exit, and if the script is killed first it still exits by itself once it has been idle for
+# SSH_MASTER_PERSIST seconds, which also removes its socket.
+SSH_MASTER_PERSIST = 60
+
+def StartSshMaster(host):
+    controlDir = tempfile.mkdtemp(prefix="eos_ssh_")
+    controlPath = os.path.join(controlDir, "master")
+    # The master stays running in the background so its output must go to /dev/null or capturing it would never finish.
+    if RunCommand(f"ssh -M -N -f -o ControlPath=\"{controlPath}\" -o ControlPersist={SSH_MASTER_PERSIST} -o BatchMode=yes \"{host}\" >/dev/null 2>&1", check=False) != 0:
+        shutil.rmtree(controlDir, ignore_errors=True)
+        PrintWarning(f"Unable to open a shared ssh connection to {host}. Each push will connect on its own.")
+        return None
+    os.environ['GIT_SSH_COMMAND'] = f"{os.environ.get("GIT_SSH_COMMAND", "ssh")} -o ControlMaster=no -o ControlPath=\"{controlPath}\""
+    atexit.register(StopSshMaster, host, controlPath)
+    return controlPath
+
+def StopSshMaster(host, controlPath):
+    RunCommand(f"ssh -O exit -o ControlPath=\"{controlPath}\" \"{host}\"", check=False)
+    shutil.rmtree(os.path.dirname(controlPath), ignore_errors=True)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import subprocess
+import os
+import sys
+import re
+import time
+import json
+import argparse
+import urllib.request
+import concurrent.futures
+
+# region EOS Script Helpers
+def WriteFile(filePath, contents, binary=False):
+    filePath = os.path.realpath(os.path.expanduser(filePath))
+    os.makedirs(os.path.dirname(filePath), exist_ok=True)
+    with open(filePath, "wb" if binary else "w", encoding=(None if binary else "UTF-8")) as file:
+        file.write(contents)
+def ReadFile(filePath, defaultContents=None, binary=False):
+    filePath = os.path.realpath(os.path.expanduser(filePath))
+    if not os.path.exists(filePath):
+        if defaultContents != None:
+            return defaultContents
+    with open(filePath, "rb" if binary else "r", encoding=(None if binary else "UTF-8")) as file:
+        return file.read()
+def RunCommand(command, echo=False, capture=False, input=None, check=True, env=None):
+    if echo and capture:
+        raise Exception("Command cannot be run with both echo and capture.")
+    result = subprocess.run(command, stdout=(None if echo else subprocess.PIPE), stderr=(None if echo else subprocess.STDOUT), input=input, env=env, check=False, shell=True, text=True)
+    if check and result.returncode != 0:
+        raise Exception(f"Sub-process returned non-zero exit code.\nExitCode: {result.returncode}\nCmdLine: {command}\n\n{result.stdout}")
+    if capture and not check:
+        return result.stdout.strip(), result.returncode
+    elif capture:
+        return result.stdout.strip()
+    elif not check:
+        return result.returncode
+    else:
+        return
+def PrintWarning(message):
+    print(f"\033[93mWarning: {message}\033[0m")
+def PrintError(message):
+    print(f"\033[91mERROR: {message}\033[0m")
+# endregion
+
+# Ranks pacman mirrors in two passes. First every candidate is probed at once for latency, then the fastest
+# responders download the same fixed size object to measure throughput. The ranking is cached for --ttl seconds.
+#
+# Candidate mirrors come from the command line, or else the Arch Linux mirror status list, or else the mirrorlist
+# already on this machine. Passing local urls such as http://127.0.0.1:8080/$repo/os/$arch makes this testable offline.
+
+MIRROR_STATUS_URL = "https://archlinux.org/mirrorlist/?protocol=https&use_mirror_status=on"
+LATENCY_OBJECT = "core/os/x86_64/core.db"
+THROUGHPUT_OBJECT = "extra/os/x86_64/extra.db"
+THROUGHPUT_BYTES = 1048576
+
+def ParseMirrorlist(contents):
+    return [ match.group(1) for match in re.finditer(r"^#?\s*Server\s*=\s*(\S+)", contents, re.MULTILINE) ]
+
+def ObjectUrl(mirror, objectPath):
+    repo, _, arch, fileName = objectPath.split("/")
+    return mirror.replace("$repo", repo).replace("$arch", arch).rstrip("/") + "/" + fileName
+
+def LoadCandidates(args):
+    if len(args.mirrors) != 0:
+        return args.mirrors
+    try:
+        statusUrl = MIRROR_STATUS_URL + "".join([ f"&country={country}" for country in args.country ])
+        with urllib.request.urlopen(urllib.request.Request(statusUrl, headers={ "User-Agent": "eos_mirrors" }), timeout=args.timeout) as response:
+            candidates = ParseMirrorlist(response.read().decode("UTF-8"))
+        if len(candidates) != 0:
+            return candidates
+    except Exception as exception:
+        PrintWarning(f"Unable to download the mirror status list so the local mirrorlist will be used. {exception}")
+    return ParseMirrorlist(ReadFile("/etc/pacman.d/mirrorlist", defaultContents=""))
+
+# Returns the seconds until the response headers arrive, or None if the mirror did not answer in time.
+def ProbeLatency(mirror, timeout):
+    try:
+        startTime = time.monotonic()
+        request = urllib.request.Request(ObjectUrl(mirror, LATENCY_OBJECT), method="HEAD", headers={ "User-Agent": "eos_mirrors" })
+        with urllib.request.urlopen(request, timeout=timeout):
+            return time.monotonic() - startTime
+    except Exception:
+        return None
+
+# Returns the bytes per second at which the first THROUGHPUT_BYTES of the throughput object downloaded.
+def ProbeThroughput(mirror, timeout):
+    try:
+        request = urllib.request.Request(ObjectUrl(mirror, THROUGHPUT_OBJECT), headers={ "User-Agent": "eos_mirrors", "Range": f"bytes=0-{THROUGHPUT_BYTES - 1}" })
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            startTime = time.monotonic()
+            received = 0
+            while received < THROUGHPUT_BYTES and time.monotonic() - startTime < timeout:
+                chunk = response.read(65536)
+                if len(chunk) == 0:
+                    break
+                received += len(chunk)
+            return received / max(time.monotonic() - startTime, 0.001)
+    except Exception:
+        return None
+
+# Returns every mirror which responded. The ones whose throughput was measured come first, fastest first, and the rest
+# follow by latency with a throughput of None so a cached ranking still has mirrors to fall back on.
+def RankMirrors(candidates, args):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        latencies = dict(zip(candidates, executor.map(lambda mirror: ProbeLatency(mirror, args.timeout), candidates)))
+        responsive = sorted([ mirror for mirror in candidates if latencies[mirror] != None ], key=lambda mirror: latencies[mirror])
+        throughputs = dict(zip(responsive[:args.probe], executor.map(lambda mirror: ProbeThroughput(mirror, args.timeout), responsive[:args.probe])))
+    ranking = [ { "url": mirror, "latency": latencies[mirror], "throughput": throughputs[mirror] } for mirror in responsive if throughputs.get(mirror) != None ]
+    ranking.sort(key=lambda mirror: (-mirror['throughput'], mirror['latency']))
+    ranking += [ { "url": mirror, "latency": latencies[mirror], "throughput": None } for mirror in responsive if throughputs.get(mirror) == None ]
+    return ranking
+
+# Returns the cached ranking, or None if the cache is missing, partial, or from an older format.
+def LoadCache(cachePath):
+    try:
+        cache = json.loads(ReadFile(cachePath, defaultContents="null"))
+    except ValueError:
+        return None
+    if not isinstance(cache, dict) or not isinstance(cache.get("timestamp"), (int, float)) or not isinstance(cache.get("ranking"), list):
+        return None
+    for mirror in cache['ranking']:
+        if not isinstance(mirror, dict) or not isinstance(mirror.get("url"), str) or not isinstance(mirror.get("latency"), (int, float)) or not isinstance(mirror.get("throughput"), (int, float, type(None))):
+            return None
+    return cache
+
+def FormatThroughput(mirror):
+    return "unmeasured" if mirror['throughput'] == None else f"{mirror['throughput'] / 1048576:.2f} MiB/s"
+
+def WriteMirrorlist(filePath, ranking, count):
+    lines = [ f"# Generated by eos_mirrors on {time.strftime("%Y-%m-%d %H:%M:%S")}" ]
+    for mirror in ranking[:count]:
+        lines.append(f"# latency {mirror['latency'] * 1000:.0f} ms, throughput {FormatThroughput(mirror)}")
+        lines.append(f"Server = {mirror['url']}")
+    WriteFile(filePath, "\n".join(lines) + "\n")
+
+def Main():
+    parser = argparse.ArgumentParser(description="Ranks pacman mirrors by latency and throughput and writes a mirrorlist.")
+    parser.add_argument("mirrors", nargs="*", help="candidate mirror urls (default: the Arch Linux mirror status list)")
+    parser.add_argument("--output", action="append", default=[], help="mirrorlist to write, may be repeated (default: /etc/pacman.d/mirrorlist)")
+    parser.add_argument("--root", action="append", default=[], help="also write ROOT/etc/pacman.d/mirrorlist, may be repeated")
+    parser.add_argument("--cache", default="/var/cache/eos_mirrors.json", help="where the ranking is cached")
+    parser.add_argument("--ttl", type=int, default=21600, help="seconds a cached ranking stays valid")
+    parser.add_argument("--force", action="store_true", help="ignore the cached ranking")
+    parser.add_argument("--country", action="append", default=[], help="only consider mirrors in this country, may be repeated")
+    parser.add_argument("--count", type=int, default=10, help="number of mirrors to write")
+    parser.add_argument("--probe", type=int, default=20, help="number of lowest latency mirrors to measure throughput for")
+    parser.add_argument("--workers", type=int, default=32, help="number of mirrors to probe at once")
+    parser.add_argument("--timeout", type=float, default=5, help="seconds to wait on each mirror")
+    args = parser.parse_args()
+    outputs = (args.output if len(args.output) != 0 else [ "/etc/pacman.d/mirrorlist" ]) + [ os.path.join(root, "etc/pacman.d/mirrorlist") for root in args.root ]
+
+    cache = LoadCache(args.cache)
+    if not args.force and cache != None and time.time() - cache['timestamp'] < args.ttl and len(cache['ranking']) != 0:
+        print(f"Using mirror ranking from {time.time() - cache['timestamp']:.0f} seconds ago.")
+        ranking = cache['ranking']
+    else:
+        candidates = LoadCandidates(args)
+        print(f"Ranking {len(candidates)} mirrors...")
+        startTime = time.monotonic()
+        ranking = RankMirrors(candidates, args)
+        if len(ranking) == 0:
+            PrintError("None of the candidate mirrors responded.")
+            return 1
+        print(f"Ranked {len(ranking)} mirrors in {time.monotonic() - startTime:.1f} seconds.")
+        WriteFile(args.cache, json.dumps({ "timestamp": time.time(), "ranking": ranking }, indent=4) + "\n")
+
+    for output in outputs:
+        WriteMirrorlist(output, ranking, args.count)
+    for mirror in ranking[:args.count]:
+        print(f"{mirror['latency'] * 1000:>6.0f} ms {FormatThroughput(mirror):>15}  {mirror['url']}")
+    return 0
+sys.exit(Main())
@@ -55,6 +55,11 @@ def Main():
     if not sudoers_good:
         WriteFile("/etc/sudoers", ReadFile("/etc/sudoers") + "yaybld ALL=(ALL) NOPASSWD: /usr/bin/pacman\n")
 
+    print("\033[36mRanking mirrors...\033[0m")
+    if RunCommand("eos_mirrors", echo=True, check=False) != 0:
+        PrintWarning("Ranking mirrors failed so the existing mirrorlist will be used.")
+    print()
+
     print("\033[36mUpdating all packages...\033[0m")
     RunCommand("sudo -u yaybld yay -Syu --noconfirm", echo=True)
     print()
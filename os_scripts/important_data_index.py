@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import json
+import socket
+import select
+import ctypes
+import errno
+import signal
+import struct
+import argparse
+# The shared code is installed to /usr/lib/eos, and in a checkout the copy next to this script is found first.
+sys.path.append("/usr/lib/eos")
+from eos_important_data import *
+
+# Keeps the scan of /important_data in memory and up to date by watching every scanned folder with inotify.
+# important_data_scan and backup_commit ask it for the scan over a Unix socket instead of walking the tree,
+# and fall back to a full scan whenever it is not running. It runs as a systemd user service:
+# systemctl --user enable --now important_data_index
+#
+# It also tracks which repos had files change since they were last marked clean so only those need a git status.
+# Every event bumps a generation counter so a repo that changes again while it is being committed stays dirty.
+#
+# The service starts at login, which can be before /important_data is mounted, and mounting or unmounting a filesystem
+# over a watched folder produces no event for the folder itself. So the device and inode of the root are recorded when
+# it is indexed and checked before every answer. Until the root is indexed again clients are told to do a full scan.
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_CLOEXEC = 0o2000000
+# Creating, deleting or renaming an entry changes the listing of the folder, anything else only makes its repo dirty.
+LISTING_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+WATCH_MASK = LISTING_EVENTS | IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+EVENT_HEADER = struct.Struct("iIII")
+
+class Index:
+    def __init__(self, rootPath):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.rootPath = rootPath
+        self.dirs = {}
+        self.contexts = {}
+        self.watches = {}
+        self.watchesByPath = {}
+        self.dirty = {}
+        # Repos with a folder which could not be watched. Changes there would go unseen so they are always dirty.
+        self.unwatched = set()
+        self.generation = 0
+        self.changed = False
+        self.problem = None
+        # The [st_dev, st_ino] of the root when it was indexed, and whether it has to be indexed again.
+        self.rootId = None
+        self.stale = False
+
+    def Watch(self, dir_path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                self.problem = "The inotify watch limit was reached. Try raising fs.inotify.max_user_watches."
+            elif error != errno.ENOENT and error != errno.ENOTDIR:
+                PrintWarning(f"Unable to watch \"{dir_path}\". {os.strerror(error)}.")
+            return False
+        self.watches[wd] = dir_path
+        self.watchesByPath[dir_path] = wd
+        return True
+
+    # Returns the listing of a folder, reusing the cached one while the inode and mtime of the folder are unchanged.
+    def List(self, dir_path, cache=None):
+        stat = os.stat(dir_path)
+        listing = None if cache == None else cache.get(dir_path)
+        if listing == None or listing['stamp'] != [ stat.st_ino, stat.st_mtime_ns ]:
+            listing = ScanDir(dir_path)
+            listing['stamp'] = [ stat.st_ino, stat.st_mtime_ns ] if stat.st_mtime_ns < time.time_ns() - 2000000000 else None
+        return listing
+
+    # Returns the hidden flag from ScanContext which the subfolders of a folder are added with.
+    def ParentContext(self, dir_path):
+        return self.contexts.get(os.path.dirname(dir_path), False)
+
+    # Returns the deepest repo which is or contains path, or None if there is not one.
+    def RepoOf(self, path):
+        while len(path) > len(self.rootPath):
+            if path in self.dirs and self.dirs[path]['repo']:
+                return path
+            path = os.path.dirname(path)
+        return None
+
+    # Lists a folder and everything under it the same way ScanTree walks it.
+    # The watch is added before listing so no change can slip in between.
+    def AddTree(self, dir_path, cache=None):
+        pending = [ (dir_path, self.ParentContext(dir_path)) ]
+        while len(pending) != 0:
+            dir_path, hidden = pending.pop()
+            watched = self.Watch(dir_path)
+            try:
+                listing = self.List(dir_path, cache)
+            except OSError:
+                continue
+            self.dirs[dir_path] = listing
+            hidden = ScanContext(listing, hidden)
+            self.contexts[dir_path] = hidden
+            repo_path = self.RepoOf(dir_path)
+            if repo_path == dir_path:
+                self.dirty[dir_path] = self.generation
+            if not watched and repo_path != None:
+                self.unwatched.add(repo_path)
+            pending += [ (os.path.join(dir_path, name), hidden) for name in listing['subdirs'] ]
+        self.changed = True
+
+    # Indexes the whole root from scratch. Every repo starts out dirty since changes may have been missed.
+    def Reindex(self, cache=None):
+        self.RemoveTree(self.rootPath)
+        self.unwatched = set()
+        self.problem = None
+        self.stale = False
+        self.rootId = self.RootId()
+        self.AddTree(self.rootPath, cache)
+
+    def RootId(self):
+        try:
+            stat = os.stat(self.rootPath)
+        except OSError:
+            return None
+        return [ stat.st_dev, stat.st_ino ]
+
+    def RemoveTree(self, dir_path):
+        for path in [ path for path in self.dirs if path == dir_path or path.startswith(dir_path + os.sep) ]:
+            self.dirs.pop(path)
+            self.contexts.pop(path)
+            self.dirty.pop(path, None)
+            self.unwatched.discard(path)
+            wd = self.watchesByPath.pop(path, None)
+            if wd != None:
+                self.watches.pop(wd, None)
+                self.libc.inotify_rm_watch(self.fd, wd)
+        self.changed = True
+
+    # Lists a folder again after an entry in it was created, deleted or renamed and adds or removes the subfolders which changed.
+    def Refresh(self, dir_path):
+        old = self.dirs.get(dir_path)
+        if old == None:
+            return
+        try:
+            listing = self.List(dir_path)
+        except OSError:
+            self.RemoveTree(dir_path)
+            return
+        # Gaining or losing a .git or an ignorecode.backup changes what everything under the folder reports.
+        if listing['repo'] != old['repo'] or listing['ignorecode'] != old['ignorecode']:
+            cache = dict(self.dirs)
+            cache[dir_path] = listing
+            self.RemoveTree(dir_path)
+            self.AddTree(dir_path, cache)
+            return
+        self.dirs[dir_path] = listing
+        for name in old['subdirs']:
+            if not name in listing['subdirs']:
+                self.RemoveTree(os.path.join(dir_path, name))
+        for name in listing['subdirs']:
+            if not name in old['subdirs']:
+                self.AddTree(os.path.join(dir_path, name))
+        self.changed = True
+
+    def MarkDirty(self, path):
+        repo_path = self.RepoOf(path)
+        if repo_path != None:
+            self.dirty[repo_path] = self.generation
+
+    def HandleEvents(self, data):
+        refresh = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+            self.generation += 1
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost so everything has to be checked again.
+                PrintWarning("The inotify event queue overflowed. Rescanning.")
+                self.Reindex(dict(self.dirs))
+                refresh = []
+                continue
+            if mask & IN_UNMOUNT or (mask & IN_IGNORED and self.watches.get(wd) == self.rootPath):
+                # The filesystem under the index went away so nothing in it can be trusted anymore.
+                self.stale = True
+            if mask & IN_IGNORED:
+                self.watchesByPath.pop(self.watches.pop(wd, None), None)
+                continue
+            if self.stale:
+                continue
+            dir_path = self.watches.get(wd)
+            if dir_path == None:
+                continue
+            if mask & LISTING_EVENTS and not dir_path in refresh:
+                refresh.append(dir_path)
+            self.MarkDirty(os.path.join(dir_path, name) if name != "" else dir_path)
+        if self.stale:
+            return
+        for dir_path in refresh:
+            self.Refresh(dir_path)
+            self.MarkDirty(dir_path)
+
+    def Answer(self, request):
+        if self.problem != None:
+            return { "error": self.problem }
+        if self.stale or self.RootId() != self.rootId:
+            self.stale = True
+            return { "error": f"{self.rootPath} was mounted or unmounted since it was indexed. It is being indexed again." }
+        if request.get("command") == "scan":
+            if request.get("root") != self.rootPath:
+                return { "error": f"This index is of {self.rootPath} not {request.get("root")}." }
+            code_paths = []
+            repo_paths = []
+            backup_file_paths = []
+            for dir_path, listing in self.dirs.items():
+                ReportListing(dir_path, listing, self.contexts[dir_path], code_paths, repo_paths, backup_file_paths)
+            return { "code_paths": sorted(code_paths), "repo_paths": sorted(repo_paths), "backup_file_paths": sorted(backup_file_paths), "dirty_repos": sorted(set(self.dirty) | self.unwatched), "generation": self.generation }
+        elif request.get("command") == "clean":
+            for repo_path in request['repos']:
+                if repo_path in self.dirty and self.dirty[repo_path] <= request['generation']:
+                    self.dirty.pop(repo_path)
+            return { "ok": True }
+        else:
+            return { "error": f"Unknown command {request.get("command")}." }
+
+    # Saves the listings in the same format as ScanTree so a full scan after the index stops is still quick.
+    def Save(self, cachePath):
+        if not self.changed:
+            return
+        cachePath = os.path.realpath(os.path.expanduser(cachePath))
+        WriteFile(cachePath + ".tmp", json.dumps({ "version": SCAN_CACHE_VERSION, "root": self.rootPath, "dirs": self.dirs }))
+        os.replace(cachePath + ".tmp", cachePath)
+        self.changed = False
+
+def HandleClient(index, connection):
+    with connection:
+        connection.settimeout(5)
+        request = b""
+        while not request.endswith(b"\n"):
+            chunk = connection.recv(65536)
+            if len(chunk) == 0:
+                break
+            request += chunk
+        try:
+            reply = index.Answer(json.loads(request))
+        except (ValueError, KeyError, TypeError) as exception:
+            reply = { "error": f"Invalid request. {exception}" }
+        connection.sendall((json.dumps(reply) + "\n").encode("UTF-8"))
+
+def Main():
+    parser = argparse.ArgumentParser(description="Keeps an inotify backed index of /important_data for important_data_scan and backup_commit.")
+    parser.add_argument("--root", default="/important_data", help="folder to index")
+    parser.add_argument("--cache", default=SCAN_CACHE_PATH, help="scan cache to start from and save the index to")
+    parser.add_argument("--socket", default=INDEX_SOCKET_PATH, help="Unix socket to answer queries on")
+    parser.add_argument("--save-interval", type=int, default=300, help="seconds between saves of the index")
+    args = parser.parse_args()
+
+    print(f"Indexing {args.root}...")
+    startTime = time.monotonic()
+    saved = json.loads(ReadFile(args.cache, defaultContents="null"))
+    index = Index(args.root)
+    index.Reindex(saved['dirs'] if saved != None and saved['version'] == SCAN_CACHE_VERSION and saved['root'] == args.root else None)
+    print(f"Indexed {len(index.dirs)} folders in {time.monotonic() - startTime:.1f} seconds.")
+    if index.problem != None:
+        PrintWarning(index.problem)
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket)
+    os.chmod(args.socket, 0o600)
+    server.listen()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        nextSave = time.monotonic() + args.save_interval
+        while True:
+            readable, _, _ = select.select([ index.fd, server ], [], [], max(nextSave - time.monotonic(), 0))
+            if index.fd in readable:
+                index.HandleEvents(os.read(index.fd, 1048576))
+            if server in readable:
+                try:
+                    HandleClient(index, server.accept()[0])
+                except OSError as exception:
+                    PrintWarning(f"Dropped a client. {exception}")
+            if index.stale:
+                print(f"Indexing {args.root} again since it was mounted or unmounted...")
+                index.Reindex()
+                print(f"Indexed {len(index.dirs)} folders.")
+                if index.problem != None:
+                    PrintWarning(index.problem)
+            if time.monotonic() >= nextSave:
+                index.Save(args.cache)
+                nextSave = time.monotonic() + args.save_interval
+    finally:
+        index.Save(args.cache)
+        server.close()
+        os.remove(args.socket)
+sys.exit(Main())
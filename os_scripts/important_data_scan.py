@@ -1,51 +1,67 @@
 #!/usr/bin/env python3
-import subprocess
 import os
 import sys
-
-# region EOS Script Helpers
-def WriteFile(filePath, contents, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    os.makedirs(os.path.dirname(filePath), exist_ok=True)
-    with open(filePath, "wb" if binary else "w", encoding=(None if binary else "UTF-8")) as file:
-        file.write(contents)
-def ReadFile(filePath, defaultContents=None, binary=False):
-    filePath = os.path.realpath(os.path.expanduser(filePath))
-    if not os.path.exists(filePath):
-        if defaultContents != None:
-            return defaultContents
-    with open(filePath, "rb" if binary else "r", encoding=(None if binary else "UTF-8")) as file:
-        return file.read()
-def RunCommand(command, echo=False, capture=False, input=None, check=True, env=None):
-    if echo and capture:
-        raise Exception("Command cannot be run with both echo and capture.")
-    result = subprocess.run(command, stdout=(None if echo else subprocess.PIPE), stderr=(None if echo else subprocess.STDOUT), input=input, env=env, check=False, shell=True, text=True)
-    if check and result.returncode != 0:
-        print(result.stdout)
-        raise Exception(f"Sub-process returned non-zero exit code.\nExitCode: {result.returncode}\nCmdLine: {command}")
-    if capture and not check:
-        return result.stdout.strip(), result.returncode
-    elif capture:
-        return result.stdout.strip()
-    elif not check:
-        return result.returncode
-    else:
-        return
-def PrintWarning(message):
-    print(f"\033[93mWarning: {message}\033[0m")
-def PrintError(message):
-    print(f"\033[91mERROR: {message}\033[0m")
-# endregion
+import time
+import argparse
+# The shared code is installed to /usr/lib/eos, and in a checkout the copy next to this script is found first.
+sys.path.append("/usr/lib/eos")
+from eos_important_data import *
 
 # Types of .backup files:
-# lastpush.backup: Stores the timestamp when the given repo was last pushed to the remote.
+# lastpush.backup: Kept in .git, stores the timestamp when the given repo was last pushed to the remote and the branch tips
+#                  which were pushed, so branches which have not moved since are not pushed again.
 # ignorerepos.backup: Tells this script not to commit, push, or warn about no remote for the git repo in the given folder.
+# audit.backup: Overrides the large file and build output audit for the git repo in the given folder.
+#               Each line is max_file_size=<size such as 200M, or 0 for no limit> or allow_build_output=true.
 # ignorecode.backup: Tells this script to silence warnings about unprotected code in the given folder recursively.
 #
 # To audit .backup files:
 # find /important_data/ -type f -name "*.backup" -not -path "*/.git/lastpush.backup"
 
+def BackupRepo(repo_path, context, messages):
+    before = RepoFingerprint(repo_path, previous=context['repo_state'].get(repo_path))
+    if before != None and context['repo_state'].get(repo_path) == before:
+        return "unchanged"
+    if not os.path.isfile(os.path.join(repo_path, ".gitignore")):
+        messages.append(("error", f"Repo missing required .gitignore. \"{repo_path}\""))
+        return "errored"
+    remote_url, status_code = RunCommand(f"git -C \"{repo_path}\" remote get-url origin", capture=True, check=False)
+    if status_code != 0 or not remote_url.startswith("git@github.com:RandomiaGaming/"):
+        messages.append(("error", f"Repo has invalid or non-existant remote origin. \"{repo_path}\"."))
+        return "errored"
+    if RunCommand(f"git -C \"{repo_path}\" rev-parse @", capture=True) != RunCommand(f"git -C \"{repo_path}\" rev-parse @{{u}}", capture=True):
+        messages.append(("error", f"Repo has become desync with remote origin. \"{repo_path}\"."))
+        return "errored"
+    # A fingerprint which no longer matches the one recorded as clean is stronger evidence than the index not seeing a change,
+    # so git status runs either way. Only a repo with no usable fingerprint is left to the index alone.
+    if before != None or repo_path in context['dirty_repos']:
+        changes = TimeStep(messages, "status", lambda: GitStatus(repo_path, context['status_options']))
+        if len(changes) == 0:
+            RecordClean(context['repo_state'], repo_path, before)
+    else:
+        changes = []
+    if len(changes) == 0:
+        return "unchanged"
+    flagged = TimeStep(messages, "audit", lambda: AuditChanges(repo_path, changes, LoadAuditSettings(repo_path)))
+    if len(flagged) != 0:
+        messages += [ ("warning", f"Repo \"{repo_path}\" was not committed because {problem}. Add it to .gitignore or allow it in audit.backup.") for problem in flagged ]
+        return "deferred"
+    messages.append(("info", f"Committing and pushing changes to \"{repo_path}\"..."))
+    TimeStep(messages, "add", lambda: StageChanges(repo_path, changes))
+    TimeStep(messages, "commit", lambda: RunCommand(f"git -C \"{repo_path}\" commit -m\"Auto-generated backup commit.\""))
+    PushBranches(repo_path, messages)
+    return "committed"
+
 def Main():
+    parser = argparse.ArgumentParser(description="Warns about unprotected code in /important_data and commits and pushes every repo in it.")
+    parser.add_argument("--jobs", type=int, default=8, help="number of repos to work on at once")
+    parser.add_argument("--rescan", action="store_true", help="list every folder instead of trusting the scan cache")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per line instead of text")
+    args = parser.parse_args()
+    if args.json:
+        EnableJsonOutput()
+    startTime = time.monotonic()
+
     # Initial scanity checks
     if os.geteuid() == 0 or os.getegid() == 0:
         script_name = os.path.splitext(os.path.basename(os.path.realpath(__file__)))[0]
@@ -62,7 +78,8 @@ def Main():
         return 1
     sshStatusEndMarker = "! You've successfully authenticated, but GitHub does not provide shell access."
     sshStatusStartMarker = "Hi "
-    sshStatus = RunCommand(f"ssh git@github.com", capture=True, check=False)[0]
+    StartSshMaster("git@github.com")
+    sshStatus = RunCommand(f"{os.environ.get("GIT_SSH_COMMAND", "ssh")} git@github.com", capture=True, check=False)[0]
     sshStatusEndMarkerPos = sshStatus.find(sshStatusEndMarker)
     sshStatusStartMarkerPos = sshStatus.rfind(sshStatusStartMarker, 0, sshStatusEndMarkerPos)
     if sshStatusEndMarkerPos == -1 or sshStatusStartMarkerPos == -1:
@@ -72,15 +89,10 @@ def Main():
 
     # Enumerating files and folders
     print("Locating repos...")
-    code_exts = [
-        ".c", ".cpp", ".cc", ".asm", ".cs", ".java", # C family
-        ".py", ".ps1", ".sh", ".cmd", ".bat", # Scripting
-        ".js", ".ts", ".html", ".css", ".htm", # Web
-        ".rb", ".swift", ".go", ".php", ".r", ".rs", ".sql", ".kt", ".dart" # Other
-    ]
-    code_paths = RunCommand(f"find \"/important_data\" -type f" + " -o".join([ f" -name \"*{code_ext}\"" for code_ext in code_exts ]), capture=True).splitlines()
-    repo_paths = [ os.path.dirname(repo_path) for repo_path in RunCommand(f"find \"/important_data/\" -type d -name \".git\"", capture=True).splitlines() ]
-    backup_file_paths = RunCommand(f"find \"/important_data/\" -type f -name \"*.backup\"", capture=True).splitlines()
+    phaseStartTime = time.monotonic()
+    scan = LoadTree("/important_data", SCAN_CACHE_PATH, args.rescan)
+    code_paths, repo_paths, backup_file_paths = scan['code_paths'], scan['repo_paths'], scan['backup_file_paths']
+    EmitEvent("phase", name="scan", seconds=round(time.monotonic() - phaseStartTime, 3), source=("scan" if scan['generation'] == None else "index"), code_files=len(code_paths), repos=len(repo_paths), backup_files=len(backup_file_paths))
     print()
     
     print("Listing backup files for audit...")
@@ -93,49 +105,41 @@ def Main():
            ignore_repos_paths.append(os.path.dirname(backup_file_path))
         elif backup_file_name == "ignorecode.backup":
            ignore_code_paths.append(os.path.dirname(backup_file_path))
-        else:
+        elif backup_file_name != "audit.backup":
             PrintWarning(f"Unknown backup file at \"{backup_file_path}\".")
     print()
 
     # Checking for unprotected code
     print("Scanning for unprotected code...")
+    phaseStartTime = time.monotonic()
+    unprotected = 0
+    repo_index = PathIndex(repo_paths)
+    ignore_code_index = PathIndex(ignore_code_paths)
+    ignore_repos_index = PathIndex(ignore_repos_paths)
     for code_path in code_paths:
-        if any([ code_path.startswith(repo_path) for repo_path in repo_paths ]):
+        if repo_index.Contains(code_path):
             continue
-        if any([ code_path.startswith(ignore_code_path) for ignore_code_path in ignore_code_paths ]):
+        if ignore_code_index.Contains(code_path):
             continue
         PrintWarning(f"Unprotected code at \"{code_path}\".")
+        unprotected += 1
+    EmitEvent("phase", name="unprotected code", seconds=round(time.monotonic() - phaseStartTime, 3), unprotected=unprotected)
     print()
 
-    for repo_path in repo_paths:
-        os.chdir(repo_path)
-        remote_url, status_code = RunCommand(f"git remote get-url origin", capture=True, check=False)
-        print(remote_url)
-
-
     # Committing and pushing git repos
     print("Committing and pushing all repos...")
-    for repo_path in repo_paths:
-        if any([ repo_path.startswith(ignore_repos_path) for ignore_repos_path in ignore_repos_paths ]):
-            continue
-        if not os.path.isfile(os.path.join(repo_path, ".gitignore")):
-            PrintError(f"Repo missing required .gitignore. \"{repo_path}\"")
-            continue
-        os.chdir(repo_path)
-        remote_url, status_code = RunCommand(f"git remote get-url origin", capture=True, check=False)
-        if status_code != 0 or not remote_url.startswith("git@github.com:RandomiaGaming/"):
-            PrintError(f"Repo has invalid or non-existant remote origin. \"{repo_path}\".")
-            continue
-        if RunCommand("git rev-parse @", capture=True) != RunCommand("git rev-parse @{u}", capture=True):
-            PrintError(f"Repo has become desync with remote origin. \"{repo_path}\".")
-            continue
-        changes = RunCommand(f"git status --porcelain", capture=True)
-        if changes != "":
-            print(f"Committing and pushing changes to \"{repo_path}\"...")
-            RunCommand(f"git rm --cached -r .")
-            RunCommand(f"git add --all")
-            RunCommand(f"git commit -m\"Auto-generated backup commit.\"")
-            RunCommand(f"git push origin --all")
+    phaseStartTime = time.monotonic()
+    dirty_repos = set(repo_paths if scan['dirty_repos'] == None else scan['dirty_repos'])
+    context = { "dirty_repos": dirty_repos, "repo_state": LoadRepoState(), "status_options": GitStatusOptions() }
+    outcomes, timings = ProcessRepos([ repo_path for repo_path in repo_paths if not ignore_repos_index.Contains(repo_path) ], lambda repo_path, messages: BackupRepo(repo_path, context, messages), args.jobs)
+    MarkClean(scan, outcomes['committed'] + outcomes['unchanged'])
+    SaveRepoState(context['repo_state'])
+    EmitEvent("phase", name="repos", seconds=round(time.monotonic() - phaseStartTime, 3))
+    print()
+    PrintRepoSummary(outcomes)
+    print()
+    PrintSlowestRepos(timings)
+    EmitEvent("summary", seconds=round(time.monotonic() - startTime, 3), unprotected=unprotected, **{ outcome: len(outcomes[outcome]) for outcome in REPO_OUTCOMES })
 
     print("Backup Complete!")
     return 0
@@ -3,5 +3,10 @@
 install -m755 -o0 -g0 ./backup_commit.py /usr/bin/backup_commit
 install -m755 -o0 -g0 ./backup_service.py /usr/bin/backup_service
 install -m755 -o0 -g0 ./eos_updates.py /usr/bin/eos_updates
+install -m755 -o0 -g0 ./eos_mirrors.py /usr/bin/eos_mirrors
+install -D -m644 -o0 -g0 ./eos_important_data.py /usr/lib/eos/eos_important_data.py
+rm -f /usr/bin/eos_important_data.py
+install -m755 -o0 -g0 ./important_data_index.py /usr/bin/important_data_index
+install -m644 -o0 -g0 ./important_data_index.service /usr/lib/systemd/user/important_data_index.service
 install -m755 -o0 -g0 ./important_data_scan.py /usr/bin/important_data_scan
 install -m755 -o0 -g0 ./sudocode.py /usr/bin/sudocode
\ No newline at end of file